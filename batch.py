@@ -0,0 +1,126 @@
+import asyncio
+import json
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from singleflight import single_flight_stats
+from utils import init_workspace
+
+def read_jobs(file:str):
+    """Reads story jobs from a JSONL file.
+
+    Each line is a json object with a `request_id`, an optional `title` and
+    either a `url` to the story or the story text in `body`.
+
+    Args:
+        file: JSONL file with one job per line
+    Returns:
+        list of job dictionaries
+    """
+    jobs = []
+    with open(file, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                jobs.append(json.loads(line))
+    return jobs
+
+def completed_jobs(output_file:str):
+    """Returns ids of jobs recorded as successful in a previous batch output."""
+    done = set()
+    if not os.path.isfile(output_file):
+        return done
+    with open(output_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                if record.get('status') == 'ok':
+                    done.add(record['request_id'])
+    return done
+
+def job_workspace(root:str, job_id:str):
+    """Returns workspace directory of a job under the batch root directory."""
+    return os.path.join(root, re.sub(r'[^\w.-]', '_', str(job_id)))
+
+def unique_jobs(jobs, root:str):
+    """Returns the jobs with the first job of every workspace, later jobs of a taken workspace are skipped.
+
+    Jobs with the same `request_id`, or ids that map to the same workspace,
+    would otherwise run at the same time and overwrite each other's files.
+    """
+    workspaces = set()
+    unique = []
+    for job in jobs:
+        ws = job_workspace(root, job['request_id'])
+        if ws in workspaces:
+            print(f"{job['request_id']}: skipped, another job of the batch uses its workspace {ws}")
+            continue
+        workspaces.add(ws)
+        unique.append(job)
+    return unique
+
+async def run_job(job:dict, make_workflow, root:str, executor):
+    """Runs one story job in its own workspace.
+
+    Args:
+        job: job dictionary
+        make_workflow: callable returning a configured workflow
+        root: batch workspace directory
+        executor: process pool for CPU bound steps
+    Returns:
+        result record for the job
+    """
+    ws = init_workspace(job_workspace(root, job['request_id']))
+    w = make_workflow()
+    w.executor = executor
+    record = {'request_id': job['request_id'], 'title': job.get('title', ''), 'workspace': ws}
+    start = time.perf_counter()
+    try:
+        result = await w.run(url=job.get('url', ''), text=job.get('body', ''), workspace=ws)
+        record.update(status='ok', result=str(result))
+    except Exception as e:
+        record.update(status='error', error=f'{type(e).__name__}: {e}')
+    record['seconds'] = round(time.perf_counter() - start, 3)
+    if w.metrics is not None:
+        w.metrics.write(ws)
+    return record
+
+async def run_batch(jobs_file:str, output_file:str, make_workflow, root:str, concurrency:int = 4, processes:int = None):
+    """Runs story jobs from a JSONL file with a bounded number of concurrent workflows.
+
+    Network bound steps of the running workflows share the event loop while
+    CPU bound steps (PDF, video encode) run in a shared process pool.
+    Identical LLM, image and URL requests in flight at the same time are
+    made once and shared. Jobs
+    already recorded as successful in `output_file` are skipped and a result
+    line with timing is appended for every job run. A job whose workspace is
+    taken by an earlier job of the file, e.g. one with the same
+    `request_id`, is skipped.
+
+    Args:
+        jobs_file: JSONL file with one job per line
+        output_file: JSONL file receiving one result line per job
+        make_workflow: callable returning a configured workflow
+        root: batch workspace directory, each job gets a sub directory
+        concurrency: maximum number of workflows running at the same time
+        processes: size of the process pool, defaults to the number of cores
+    Returns:
+        list of result records
+    """
+    done = completed_jobs(output_file)
+    jobs = unique_jobs([job for job in read_jobs(jobs_file) if job['request_id'] not in done], root)
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    records = []
+    with ProcessPoolExecutor(processes) as executor, open(output_file, 'a', encoding='utf-8') as out:
+        async def run(job):
+            async with semaphore:
+                record = await run_job(job, make_workflow, root, executor)
+            out.write(json.dumps(record) + '\n')
+            out.flush()
+            records.append(record)
+            print(f"{record['request_id']}: {record['status']} in {record['seconds']}s")
+        await asyncio.gather(*(run(job) for job in jobs))
+    for name, stats in single_flight_stats().items():
+        print(f"{name}: {stats['saved']} of {stats['calls']} calls shared with an identical call in flight")
+    return records
@@ -0,0 +1,87 @@
+"""Measures cold start time of the CLI and of the subsystems it loads lazily.
+
+Every measurement runs in a fresh interpreter, so nothing is shared between
+runs except the operating system file cache. Run from the repository root:
+
+    python -m benchmarks.import_time --repeat 5 --top 15
+
+The subsystem rows show what a run pays the first time a step needs them.
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+
+STARTUP_COMMANDS = {
+    'import storygen': ['-c', 'import storygen'],
+    'storygen.py --help': ['storygen.py', '--help'],
+}
+
+#heavy dependencies imported by the steps that need them
+SUBSYSTEMS = {
+    'llama_index': 'llama_index.core',
+    'nvidia llm': 'llama_index.llms.nvidia',
+    'guardrails': 'nemoguardrails',
+    'video': 'moviepy.editor',
+    'pdf': 'reportlab.platypus',
+    'pdf reader': 'pymupdf',
+    'tts': 'gtts',
+}
+
+def run_seconds(args, repeat:int):
+    """Returns import times of running the interpreter with args in fresh processes."""
+    timings = []
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, '-X', 'importtime', *args], capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f'{" ".join(args)} failed: {result.stderr.splitlines()[-1:]}')
+        timings.append(total_import_seconds(result.stderr))
+    return timings
+
+def parse_importtime(output:str):
+    """Returns (cumulative microseconds, depth, module) of every line of -X importtime output."""
+    rows = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        rows.append((int(cumulative), depth, name.strip()))
+    return rows
+
+def total_import_seconds(output:str):
+    """Returns the time spent importing modules, summed over the top level imports."""
+    return sum(cumulative for cumulative, depth, _ in parse_importtime(output) if depth == 0) / 1e6
+
+def top_imports(args, top:int):
+    """Returns the slowest top level imports of a command."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', *args], capture_output=True, text=True)
+    rows = [(cumulative, name) for cumulative, depth, name in parse_importtime(result.stderr) if depth <= 1]
+    return sorted(rows, reverse=True)[:top]
+
+def print_row(name:str, timings):
+    print(f"{name:<24}{min(timings):>10.3f}{statistics.median(timings):>10.3f}{max(timings):>10.3f}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks cold start and lazy import times')
+    parser.add_argument('-n', '--repeat', help='Number of fresh processes per measurement', type=int, default=3)
+    parser.add_argument('--top', help='Show the slowest imports of `import storygen`', type=int, default=0)
+    parser.add_argument('--no-subsystems', help='Only measure the CLI start up', action='store_true')
+    args = parser.parse_args()
+
+    print(f"{'import seconds':<24}{'min':>10}{'median':>10}{'max':>10}")
+    for name, command in STARTUP_COMMANDS.items():
+        print_row(name, run_seconds(command, args.repeat))
+    if not args.no_subsystems:
+        for name, module in SUBSYSTEMS.items():
+            try:
+                print_row(f'+ {name}', run_seconds(['-c', f'import {module}'], args.repeat))
+            except RuntimeError:
+                print(f"{'+ ' + name:<24}{'not installed':>10}")
+    if args.top:
+        print('\nslowest imports of `import storygen`')
+        for cumulative, name in top_imports(STARTUP_COMMANDS['import storygen'], args.top):
+            print(f"{name:<48}{cumulative / 1e6:>10.3f}")
+
+if __name__ == '__main__':
+    main()
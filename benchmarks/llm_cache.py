@@ -0,0 +1,86 @@
+"""Checks the cached NVIDIA LLM end to end against a local stand-in of the NIM endpoint.
+
+The real CachedNVIDIA client talks to the OpenAI compatible stub of the
+pipeline benchmark, so the llama_index request path, the completion cache,
+the coalescing of identical calls and the token counting are all exercised.
+No API key or network access is needed:
+
+    python -m benchmarks.llm_cache --latency 0.2 --concurrency 8
+
+Exits with status 1 when a check fails.
+"""
+import argparse
+import asyncio
+import sys
+import tempfile
+import time
+
+from llama_index.core.llms import ChatMessage
+
+from benchmarks.pipeline import (PROMPT_TEXT, start_llm_server)
+from cache import DiskCache
+from llm_cache import CachedNVIDIA
+from metrics import (RunMetrics, measure)
+from storygen import MODEL_NAME
+
+failures = []
+
+def check(ok:bool, message:str):
+    print(f"{'ok' if ok else 'FAILED':<8}{message}")
+    if not ok:
+        failures.append(message)
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+async def run_checks(llm:CachedNVIDIA, server, concurrency:int):
+    messages = [ChatMessage(role='user', content='Describe the sparrow')]
+
+    response, uncached = timed(llm.complete, 'complete prompt')
+    check(response.text == PROMPT_TEXT and server.requests == 1, f'complete calls the endpoint ({uncached:.3f}s)')
+    response, cached = timed(llm.complete, 'complete prompt')
+    check(response.text == PROMPT_TEXT and server.requests == 1, f'repeated complete is served from the cache ({cached:.3f}s)')
+
+    response = await llm.acomplete('acomplete prompt')
+    check(response.text == PROMPT_TEXT and server.requests == 2, 'acomplete calls the endpoint')
+    response = llm.chat(messages)
+    check(response.message.content == PROMPT_TEXT and server.requests == 3, 'chat calls the endpoint')
+    response = await llm.achat(messages)
+    check(response.message.content == PROMPT_TEXT and server.requests == 3, 'repeated achat is served from the cache')
+
+    responses = await asyncio.gather(*(llm.acomplete('shared prompt') for _ in range(concurrency)))
+    check(all(r.text == PROMPT_TEXT for r in responses) and server.requests == 4,
+          f'{concurrency} concurrent identical acomplete calls make one request')
+
+    stream = await llm.astream_complete('stream prompt')
+    text = ''.join([r.delta async for r in stream])
+    check(text == PROMPT_TEXT and server.requests == 5, 'astream_complete streams from the endpoint')
+    stream = await llm.astream_complete('stream prompt')
+    text = ''.join([r.delta async for r in stream])
+    check(text == PROMPT_TEXT and server.requests == 5, 'repeated astream_complete is replayed from the cache')
+
+def main():
+    parser = argparse.ArgumentParser(description='Checks CachedNVIDIA against a local stand-in of the NIM endpoint')
+    parser.add_argument('--latency', help='Mean LLM response time in seconds', type=float, default=0.1)
+    parser.add_argument('-c', '--concurrency', help='Number of concurrent identical calls', type=int, default=8)
+    args = parser.parse_args()
+
+    server = start_llm_server(args.latency, 0.0, 0.0)
+    metrics = RunMetrics()
+    try:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            llm = CachedNVIDIA(model=MODEL_NAME, api_key='stub', base_url=f'http://127.0.0.1:{server.server_port}/v1',
+                               cache=DiskCache(cache_dir, 16 * 1024 * 1024))
+            with measure('llm_cache', 'step', metrics):
+                asyncio.run(run_checks(llm, server, args.concurrency))
+    finally:
+        server.shutdown()
+    totals = metrics.report()['totals']
+    check(totals['cache_hits'] >= 3 and totals['prompt_tokens'] > 0 and totals['completion_tokens'] > 0,
+          f"cache hits and token usage are measured ({totals['cache_hits']} hits, {totals['prompt_tokens']} prompt tokens)")
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+"""Compares size and build time of the story PDF for every image profile.
+
+Run from the repository root on a workspace of a finished run, i.e. one with
+story.json and image/<n>.jpg page images:
+
+    python -m benchmarks.pdf_size --workspace ./data
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from image_gen import (PDF_PROFILES, create_pdf)
+from utils import read_story_json
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks PDF image profiles')
+    parser.add_argument('-w', '--workspace', help='Workspace of a finished run', default='./data')
+    parser.add_argument('-n', '--repeat', help='Number of builds per profile', type=int, default=1)
+    args = parser.parse_args()
+
+    story = read_story_json(f'{args.workspace}/story.json')
+    image_path = f'{args.workspace}/image'
+    print(f"{'profile':<10}{'seconds':>10}{'size (KB)':>12}{'time':>8}{'size':>8}")
+    baseline = None
+    with tempfile.TemporaryDirectory() as out_dir:
+        for profile in PDF_PROFILES:
+            output_file = f'{out_dir}/{profile}.pdf'
+            timings = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                create_pdf(output_file, story, image_path, profile)
+                timings.append(time.perf_counter() - start)
+            seconds, size = min(timings), os.path.getsize(output_file)
+            baseline = baseline or (seconds, size)
+            print(f"{profile:<10}{seconds:>10.2f}{size / 1024:>12.1f}{seconds / baseline[0]:>8.0%}{size / baseline[1]:>8.0%}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+"""End to end benchmark of the story workflow against local stand-ins of the services.
+
+The NVIDIA LLM and stable diffusion endpoints are replaced by local HTTP
+servers and the TTS engine by a backend producing silent narration, each
+with configurable latency, jitter and error rate. The workflow talks to the
+LLM stand-in through the real CachedNVIDIA client, so caching, coalescing
+and token counting are part of every run. No API key or network access is
+needed. Runs start from a generated story.json,
+so the sweep covers prompt and image generation, narration, frames, PDF and
+video encoding for every combination of book size and concurrency:
+
+    python -m benchmarks.pipeline --pages 4,8,16 --concurrency 2,8 --output bench.json
+
+Per stage latency comes from the metrics report of each run.
+"""
+import argparse
+import asyncio
+import base64
+import io
+import json
+import os
+import random
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+from llama_index.core import Settings
+
+from cache import DiskCache
+from image_gen import ImageGenClient
+from llm_cache import CachedNVIDIA
+from metrics import RunMetrics
+from models import ChildrenStory, StoryPage
+from storygen import (MODEL_NAME, ChildrenStoryGenerationWorkflow)
+from tts import TTSBackend
+from utils import write_file
+from video_gen import ffmpeg_binary
+
+STORY_TEXT = 'The little sparrow looked for the lost bean under every leaf of the old garden.'
+PROMPT_TEXT = 'Prompt: a small sparrow searching a sunny garden, watercolor children book illustration'
+
+def delay(latency:float, jitter:float):
+    """Returns a random delay of latency seconds give or take the jitter fraction."""
+    return max(0.0, latency * (1 + random.uniform(-jitter, jitter)))
+
+class StubTTSBackend(TTSBackend):
+    """Fake TTS engine returning silent MP3 narration as long as the text would take to read."""
+    name = 'stub'
+    latency = 0.1
+    jitter = 0.0
+    error_rate = 0.0
+
+    def synthesize(self, text:str) -> bytes:
+        time.sleep(delay(self.latency, self.jitter))
+        if random.random() < self.error_rate:
+            raise RuntimeError('injected TTS error')
+        return silent_mp3(max(1, round(len(text) / 15)))
+
+@lru_cache(maxsize=None)
+def silent_mp3(seconds:int):
+    """Returns silent MP3 audio of the given length."""
+    return subprocess.run([ffmpeg_binary(), '-loglevel', 'error', '-f', 'lavfi', '-i', 'anullsrc=r=24000:cl=mono',
+                           '-t', str(seconds), '-f', 'mp3', 'pipe:1'], check=True, capture_output=True).stdout
+
+def start_image_server(latency:float, jitter:float, error_rate:float, size=(1344, 768)):
+    """Starts a local stand-in of the stable diffusion endpoint.
+
+    Args:
+        latency: mean response time in seconds
+        jitter: fraction of the latency the response time varies by
+        error_rate: fraction of requests answered with a 503
+        size: size of the returned image
+    Returns:
+        the running server, its url is http://127.0.0.1:<server_port>/
+    """
+    buf = io.BytesIO()
+    Image.effect_noise(size, 64).convert('RGB').save(buf, 'JPEG')
+    body = json.dumps({'image': base64.b64encode(buf.getvalue()).decode('ascii')}).encode('utf-8')
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            time.sleep(delay(latency, jitter))
+            if random.random() < error_rate:
+                self.send_response(503)
+                self.send_header('Retry-After', '0')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def start_llm_server(latency:float, jitter:float, error_rate:float, reply = PROMPT_TEXT, models = (MODEL_NAME,)):
+    """Starts a local stand-in of the OpenAI compatible chat completions endpoint of a NIM.
+
+    Args:
+        latency: mean response time in seconds
+        jitter: fraction of the latency the response time varies by
+        error_rate: fraction of requests answered with a 503
+        reply: text of every completion, or a function of the request messages returning it
+        models: model ids listed by the endpoint
+    Returns:
+        the running server, its base url is http://127.0.0.1:<server_port>/v1 and
+        its `requests` attribute counts the completion requests it answered
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps({'object': 'list', 'data': [{'id': model, 'object': 'model', 'owned_by': 'stub'} for model in models]}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            time.sleep(delay(latency, jitter))
+            if random.random() < error_rate:
+                self.send_response(503)
+                self.send_header('Retry-After', '0')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            with lock:
+                server.requests += 1
+            text = reply(request['messages']) if callable(reply) else reply
+            usage = {'prompt_tokens': len(json.dumps(request['messages'])) // 4, 'completion_tokens': len(text) // 4}
+            usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+            completion = {'id': 'stub', 'created': int(time.time()), 'model': request['model']}
+            if request.get('stream'):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.end_headers()
+                pieces = [text[i:i + 16] for i in range(0, len(text), 16)]
+                for number, piece in enumerate(pieces):
+                    last = number == len(pieces) - 1
+                    chunk = {**completion, 'object': 'chat.completion.chunk', 'choices': [
+                        {'index': 0, 'delta': {'role': 'assistant', 'content': piece}, 'finish_reason': 'stop' if last else None}]}
+                    self.wfile.write(f'data: {json.dumps(chunk)}\n\n'.encode('utf-8'))
+                self.wfile.write(b'data: [DONE]\n\n')
+                return
+            body = json.dumps({**completion, 'object': 'chat.completion', 'usage': usage, 'choices': [
+                {'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}]}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    lock = threading.Lock()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    server.requests = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def stub_nvidia(server, cache:DiskCache = None):
+    """Returns the LLM client of the workflow pointed at a local stand-in of the NIM endpoint."""
+    return CachedNVIDIA(model=MODEL_NAME, api_key='stub', base_url=f'http://127.0.0.1:{server.server_port}/v1', cache=cache)
+
+def sample_story(pages:int):
+    """Returns a story with the given number of pages."""
+    return ChildrenStory(title='The Sparrow and the Lost Bean',
+                         pages=[StoryPage(page_no=number, content=f'{STORY_TEXT} Page {number}.') for number in range(1, pages + 1)])
+
+async def run_once(args, pages:int, concurrency:int, llm_server, image_url:str, executor):
+    """Runs the workflow on a fresh workspace with an empty LLM cache and returns its result record."""
+    with tempfile.TemporaryDirectory() as ws:
+        write_file(sample_story(pages).json(), f'{ws}/story.json')
+        Settings.llm = stub_nvidia(llm_server, DiskCache(f'{ws}/llm_cache', 64 * 1024 * 1024))
+        w = ChildrenStoryGenerationWorkflow(timeout=3600)
+        w.max_concurrency = concurrency
+        w.image_url = image_url
+        w.image_client = ImageGenClient('stub', invoke_url=image_url, max_concurrency=concurrency)
+        w.renderer = args.renderer
+        w.video_only = args.video_only
+        w.create_pdf = args.pdf
+        w.executor = executor
+        w.tts_backend = StubTTSBackend()
+        w.metrics = RunMetrics()
+        record = {'pages': pages, 'concurrency': concurrency, 'status': 'ok'}
+        start = time.perf_counter()
+        try:
+            await w.run(workspace=ws)
+        except Exception as e:
+            record.update(status='error', error=f'{type(e).__name__}: {e}')
+        finally:
+            await w.image_client.aclose()
+        record['seconds'] = round(time.perf_counter() - start, 3)
+        record['pages_per_second'] = round((pages + 1) / record['seconds'], 3)
+        report = w.metrics.report()
+        record['stages'] = {name: {field: s[field] for field in ('count', 'wall_seconds', 'max_wall_seconds', 'wait_seconds')}
+                            for name, s in {**report['steps'], **report['calls']}.items()}
+        record['totals'] = report['totals']
+        return record
+
+def print_record(record):
+    print(f"{record['pages']:>6}{record['concurrency']:>6}{record['status']:>8}{record['seconds']:>10.2f}{record['pages_per_second']:>10.2f}")
+    for name, s in record['stages'].items():
+        print(f"{'':>12}{name:<22}{s['count']:>6}{s['wall_seconds']:>10.2f}{s['max_wall_seconds']:>10.2f}{s['wait_seconds']:>10.2f}")
+
+async def sweep(args):
+    image_server = start_image_server(args.image_latency, args.jitter, args.image_error_rate)
+    image_url = f'http://127.0.0.1:{image_server.server_port}/'
+    llm_server = start_llm_server(args.llm_latency, args.jitter, args.llm_error_rate)
+    StubTTSBackend.latency = args.tts_latency
+    StubTTSBackend.jitter = args.jitter
+    StubTTSBackend.error_rate = args.tts_error_rate
+    os.environ.setdefault('NVIDIA_API_KEY', 'stub')
+    executor = ProcessPoolExecutor(args.processes) if args.processes else None
+    records = []
+    print(f"{'pages':>6}{'conc':>6}{'status':>8}{'seconds':>10}{'pages/s':>10}")
+    print(f"{'':>12}{'stage':<22}{'count':>6}{'total s':>10}{'max s':>10}{'wait s':>10}")
+    try:
+        for pages in args.pages:
+            for concurrency in args.concurrency:
+                for _ in range(args.repeat):
+                    record = await run_once(args, pages, concurrency, llm_server, image_url, executor)
+                    print_record(record)
+                    records.append(record)
+    finally:
+        image_server.shutdown()
+        llm_server.shutdown()
+        if executor is not None:
+            executor.shutdown()
+    return records
+
+def int_list(value:str):
+    return [int(v) for v in value.split(',')]
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the story workflow offline against local service stand-ins')
+    parser.add_argument('--pages', help='Comma separated book sizes', type=int_list, default=[4, 8])
+    parser.add_argument('--concurrency', help='Comma separated concurrency limits', type=int_list, default=[2, 8])
+    parser.add_argument('-n', '--repeat', help='Number of runs per combination', type=int, default=1)
+    parser.add_argument('-r', '--renderer', help='Video renderer', choices=['clips', 'still'], default='clips')
+    parser.add_argument('--video-only', help='Compose video frames directly and skip the PDF', action='store_true')
+    parser.add_argument('-p', '--pdf', help='Generate the PDF only', action='store_true')
+    parser.add_argument('--processes', help='Run CPU bound stages in a process pool of this size', type=int)
+    parser.add_argument('--llm-latency', help='Mean LLM response time in seconds', type=float, default=0.2)
+    parser.add_argument('--image-latency', help='Mean image response time in seconds', type=float, default=0.5)
+    parser.add_argument('--tts-latency', help='Mean TTS response time in seconds', type=float, default=0.1)
+    parser.add_argument('--jitter', help='Fraction the response times vary by', type=float, default=0.2)
+    parser.add_argument('--llm-error-rate', help='Fraction of LLM requests answered with a 503', type=float, default=0.0)
+    parser.add_argument('--image-error-rate', help='Fraction of image requests answered with a 503', type=float, default=0.0)
+    parser.add_argument('--tts-error-rate', help='Fraction of failing TTS calls', type=float, default=0.0)
+    parser.add_argument('--seed', help='Random seed of the latency and error injection', type=int, default=0)
+    parser.add_argument('-o', '--output', help='JSON file receiving the results')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    records = asyncio.run(sweep(args))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'started': time.time(), 'options': vars(args), 'runs': records}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""Load test of the story server against local stand-ins of the services.
+
+Starts the server in process with the LLM, image endpoint and TTS engine
+stand-ins of the pipeline benchmark, submits jobs over HTTP at a steady rate
+and follows the progress events of every job. No API key or network access
+is needed:
+
+    python -m benchmarks.server --jobs 16 --rate 2 --concurrency 4 --pages 4
+
+Per job overhead is the time a job spends in the server outside of its
+workflow run and its wait in the queue, i.e. submission and start up.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import httpx
+from llama_index.core import Settings
+
+from batch import job_workspace
+from benchmarks.pipeline import (StubTTSBackend, sample_story, start_image_server, start_llm_server, stub_nvidia)
+from cache import DiskCache
+from image_gen import ImageGenClient
+from manifest import (load_manifest, input_hash)
+from metrics import RunMetrics
+from server import (StoryServer, start_server, warm_up)
+from storygen import (RAW_STORY_FILE, STORY_JSON_FILE, ChildrenStoryGenerationWorkflow)
+from utils import (init_workspace, write_file)
+
+async def run_job(client:httpx.AsyncClient, number:int, root:str, args):
+    """Submits a job and follows its events until it is finished.
+
+    The story.json of the job is written to its workspace beforehand and
+    recorded as generated from the job text, so the job starts at the page
+    steps like the runs of the pipeline benchmark.
+
+    Returns:
+        result record of the job
+    """
+    job = {'request_id': f'job-{number}', 'body': 'story', 'priority': number % args.priorities, 'options': {'pdf': args.pdf}}
+    ws = init_workspace(job_workspace(root, job['request_id']))
+    write_file(job['body'], f'{ws}/{RAW_STORY_FILE}')
+    load_manifest(ws).record(RAW_STORY_FILE, input_hash(job['body']))
+    write_file(sample_story(args.pages).json(), f'{ws}/{STORY_JSON_FILE}')
+    submitted = time.perf_counter()
+    response = await client.post('/jobs', json=job)
+    accepted = time.perf_counter()
+    if response.status_code != 202:
+        return {'request_id': job['request_id'], 'status': 'refused', 'http_status': response.status_code}
+    job_id = response.json()['id']
+    first_event = None
+    events = 0
+    async with client.stream('GET', f'/jobs/{job_id}/events') as stream:
+        async for line in stream.aiter_lines():
+            if not line:
+                continue
+            event = json.loads(line)
+            events += 1
+            if first_event is None and event['event'] != 'started':
+                first_event = time.perf_counter()
+            if event['event'] == 'finished':
+                finished = time.perf_counter()
+                break
+    record = {key: event.get(key) for key in ('request_id', 'status', 'queued_seconds', 'seconds', 'error')}
+    record.update(submit_seconds=round(accepted - submitted, 6), end_to_end_seconds=round(finished - submitted, 6), events=events,
+                  first_event_seconds=round((first_event or finished) - submitted, 6))
+    record['overhead_seconds'] = round(record['end_to_end_seconds'] - record['seconds'] - record['queued_seconds'], 6)
+    return record
+
+async def load(args):
+    image_server = start_image_server(args.image_latency, args.jitter, 0.0)
+    llm_server = start_llm_server(args.llm_latency, args.jitter, 0.0)
+    StubTTSBackend.latency = args.tts_latency
+    StubTTSBackend.jitter = args.jitter
+    os.environ.setdefault('NVIDIA_API_KEY', 'stub')
+    image_client = ImageGenClient('stub', invoke_url=f'http://127.0.0.1:{image_server.server_port}/', max_concurrency=args.image_concurrency)
+    tts_backend = StubTTSBackend()
+
+    def make_workflow():
+        w = ChildrenStoryGenerationWorkflow(timeout=3600)
+        w.image_client = image_client
+        w.tts_backend = tts_backend
+        w.metrics = RunMetrics()
+        return w
+
+    processes = args.processes or os.cpu_count() or 1
+    with tempfile.TemporaryDirectory() as root, ProcessPoolExecutor(processes) as executor:
+        Settings.llm = stub_nvidia(llm_server, DiskCache(f'{root}/llm_cache', 64 * 1024 * 1024))
+        start = time.perf_counter()
+        await warm_up(executor, processes)
+        print(f'warm up: {time.perf_counter() - start:.2f}s')
+        server = StoryServer(make_workflow, root, args.concurrency, args.queue_size, executor)
+        listener = await start_server(server, '127.0.0.1', 0)
+        port = listener.sockets[0].getsockname()[1]
+        try:
+            async with httpx.AsyncClient(base_url=f'http://127.0.0.1:{port}', timeout=None) as client:
+                tasks = []
+                start = time.perf_counter()
+                for number in range(args.jobs):
+                    tasks.append(asyncio.create_task(run_job(client, number, root, args)))
+                    await asyncio.sleep(random.expovariate(args.rate) if args.rate else 0)
+                records = await asyncio.gather(*tasks)
+                seconds = time.perf_counter() - start
+                stats = (await client.get('/stats')).json()
+        finally:
+            listener.close()
+            image_server.shutdown()
+            llm_server.shutdown()
+            await image_client.aclose()
+    return records, seconds, stats
+
+def summary(records, seconds:float):
+    ok = [record for record in records if record['status'] == 'ok']
+    print(f"{len(ok)} of {len(records)} jobs ok in {seconds:.2f}s, {len(ok) / seconds:.2f} jobs/s")
+    for field in ('submit_seconds', 'first_event_seconds', 'queued_seconds', 'seconds', 'end_to_end_seconds', 'overhead_seconds'):
+        values = [record[field] for record in ok]
+        if values:
+            print(f"{field:<22}{statistics.median(values):>10.4f}{max(values):>10.4f}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Load tests the story server offline against local service stand-ins')
+    parser.add_argument('-n', '--jobs', help='Number of jobs submitted', type=int, default=8)
+    parser.add_argument('--rate', help='Mean job submissions per second, 0 submits all at once', type=float, default=2.0)
+    parser.add_argument('-c', '--concurrency', help='Number of jobs running at the same time', type=int, default=4)
+    parser.add_argument('--queue-size', help='Maximum number of queued jobs', type=int, default=64)
+    parser.add_argument('--priorities', help='Number of job priorities cycled through', type=int, default=1)
+    parser.add_argument('--pages', help='Pages per story', type=int, default=4)
+    parser.add_argument('-p', '--pdf', help='Generate the PDF only', action='store_true')
+    parser.add_argument('--processes', help='Size of the process pool', type=int)
+    parser.add_argument('--image-concurrency', help='Maximum number of in-flight image requests of all jobs', type=int, default=8)
+    parser.add_argument('--llm-latency', help='Mean LLM response time in seconds', type=float, default=0.2)
+    parser.add_argument('--image-latency', help='Mean image response time in seconds', type=float, default=0.5)
+    parser.add_argument('--tts-latency', help='Mean TTS response time in seconds', type=float, default=0.1)
+    parser.add_argument('--jitter', help='Fraction the response times vary by', type=float, default=0.2)
+    parser.add_argument('--seed', help='Random seed of the arrivals and latencies', type=int, default=0)
+    parser.add_argument('-o', '--output', help='JSON file receiving the results')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    records, seconds, stats = asyncio.run(load(args))
+    summary(records, seconds)
+    print(f"server: {json.dumps(stats)}")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'started': time.time(), 'options': vars(args), 'seconds': seconds, 'stats': stats, 'jobs': records}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""Compares the per page clip renderer with the single pass still image renderer.
+
+Run from the repository root on a workspace of a finished run, i.e. one with
+story.json, image/<n>.png frames and audio/<n>.mp3 narration:
+
+    python -m benchmarks.video_render --workspace ./data --processes 4
+
+Page clips are encoded with merge_audio_video in a process pool like the
+generate_clip step does.
+"""
+import argparse
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from utils import read_story_json
+from video_gen import (merge_audio_video, save_video, save_still_video)
+
+def bench_clips(story, image_path, audio_path, out_dir, executor):
+    """Renders with per page clips and stream copy concat, returns the output file."""
+    output_file = f'{out_dir}/clips.mp4'
+    pages = [page.page_no for page in story.pages]
+    image_files = [f'{image_path}/0.png'] + [f'{image_path}/{number}.png' for number in pages]
+    audio_files = [f'{audio_path}/title.mp3'] + [f'{audio_path}/{number}.mp3' for number in pages]
+    video_files = [f'{out_dir}/0.mp4'] + [f'{out_dir}/{number}.mp4' for number in pages]
+    list(executor.map(merge_audio_video, image_files, audio_files, video_files))
+    save_video(len(story.pages) + 1, out_dir, output_file)
+    return output_file
+
+def bench_still(story, image_path, audio_path, out_dir, executor):
+    """Renders with the single pass still image profile, returns the output file."""
+    output_file = f'{out_dir}/still.mp4'
+    save_still_video(story, image_path, audio_path, output_file)
+    return output_file
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks video renderers')
+    parser.add_argument('-w', '--workspace', help='Workspace of a finished run', default='./data')
+    parser.add_argument('-n', '--repeat', help='Number of runs per renderer', type=int, default=1)
+    parser.add_argument('--processes', help='Size of the process pool encoding page clips', type=int)
+    args = parser.parse_args()
+
+    story = read_story_json(f'{args.workspace}/story.json')
+    image_path = f'{args.workspace}/image'
+    audio_path = f'{args.workspace}/audio'
+    print(f"{'renderer':<10}{'seconds':>10}{'size (KB)':>12}")
+    with ProcessPoolExecutor(args.processes) as executor:
+        for name, bench in (('clips', bench_clips), ('still', bench_still)):
+            timings = []
+            for _ in range(args.repeat):
+                with tempfile.TemporaryDirectory() as out_dir:
+                    start = time.perf_counter()
+                    output_file = bench(story, image_path, audio_path, out_dir, executor)
+                    timings.append(time.perf_counter() - start)
+                    size = os.path.getsize(output_file)
+            print(f"{name:<10}{min(timings):>10.2f}{size / 1024:>12.1f}")
+
+if __name__ == '__main__':
+    main()
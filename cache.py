@@ -0,0 +1,111 @@
+import contextlib
+import hashlib
+import json
+import os
+import threading
+from contextvars import ContextVar
+
+_bypass = ContextVar('cache_bypass', default=False)
+
+#a full cache is trimmed to this fraction of its size limit, so the directory is rescanned once per tenth of the limit written
+EVICT_RATIO = 0.9
+
+@contextlib.contextmanager
+def bypass_cache(enabled:bool = True):
+    """Skips cache lookups for everything run inside the block.
+
+    Fresh results are still written to the cache, so a bypassed run refreshes
+    the entries it touches. Tasks created inside the block inherit the flag.
+
+    Args:
+        enabled: whether lookups are skipped
+    """
+    token = _bypass.set(enabled)
+    try:
+        yield
+    finally:
+        _bypass.reset(token)
+
+def cache_key(*parts):
+    """Returns a stable hash for json serializable key parts."""
+    data = json.dumps(parts, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+class DiskCache:
+    """Content addressed on-disk cache with size bounded LRU eviction.
+
+    Entries are stored as files named after their key. Reading an entry
+    refreshes its modification time, and the least recently used entries are
+    removed once the total size exceeds `max_bytes`, down to `EVICT_RATIO` of it.
+
+    Args:
+        path: cache directory
+        max_bytes: maximum total size of cached entries
+    """
+    def __init__(self, path:str, max_bytes:int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._size = sum(size for _, _, size in self._entries())
+
+    def _file(self, key:str):
+        return os.path.join(self.path, key[:2], key)
+
+    def _entries(self):
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                if name.endswith('.tmp'):
+                    continue
+                file = os.path.join(root, name)
+                try:
+                    stat = os.stat(file)
+                except FileNotFoundError:
+                    continue
+                yield file, stat.st_mtime, stat.st_size
+
+    def get(self, key:str):
+        """Returns cached bytes for the key or None."""
+        if _bypass.get():
+            return None
+        file = self._file(key)
+        try:
+            with open(file, 'rb') as f:
+                value = f.read()
+            os.utime(file)
+        except FileNotFoundError:
+            return None
+        return value
+
+    def set(self, key:str, value:bytes):
+        """Stores bytes for the key and evicts old entries if needed."""
+        file = self._file(key)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        tmp_file = f'{file}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(value)
+        with self._lock:
+            old_size = os.path.getsize(file) if os.path.isfile(file) else 0
+            os.replace(tmp_file, file)
+            self._size += len(value) - old_size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        self._size = sum(size for _, _, size in entries)
+        for file, _, size in entries:
+            if self._size <= self.max_bytes * EVICT_RATIO:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(file)
+                self._size -= size
+
+    def get_json(self, key:str):
+        """Returns cached json value for the key or None."""
+        value = self.get(key)
+        return None if value is None else json.loads(value)
+
+    def set_json(self, key:str, value):
+        """Stores json serializable value for the key."""
+        self.set(key, json.dumps(value).encode('utf-8'))
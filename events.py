@@ -1,30 +1,56 @@
 from models import ChildrenStory
-from llama_index.core.workflow import Event
-class PromptEvent(Event):
-    path: str
-    story: ChildrenStory
-
+from workflows.events import Event
 class RawStoryEvent(Event):
+    workspace: str
     path: str
 
 class StoryEvent(Event):
+    workspace: str
     story: str
 
 class StorySummaryEvent(Event):
+    workspace: str
     story: str
 
 class ChildrenStoryEvent(Event):
+    workspace: str
     story: ChildrenStory
+    #set when the page narration was already started while the story was generated
+    narrated: bool = False
 
-class BookImageEvent(Event):
-    path: str
+#page events carry the page number, 0 being the title page
+class PageEvent(Event):
+    workspace: str
     story: ChildrenStory
-    
-class PDFEvent(Event):
-    path: str
+    number: int
+
+class PageNarrationEvent(Event):
+    workspace: str
     story: ChildrenStory
+    number: int
 
-class AudioEvent(Event):
-    path: str
+class PagePromptEvent(Event):
+    workspace: str
     story: ChildrenStory
-    pdf: str
+    number: int
+
+class PageImageEvent(Event):
+    workspace: str
+    story: ChildrenStory
+    number: int
+
+class PageAudioEvent(Event):
+    workspace: str
+    story: ChildrenStory
+    number: int
+
+class PageReadyEvent(Event):
+    workspace: str
+    story: ChildrenStory
+    number: int
+
+#written to the event stream of a run whenever a page is ready, for progress reporting
+class PageProgressEvent(Event):
+    workspace: str
+    number: int
+    total: int
@@ -0,0 +1,66 @@
+import re
+from functools import lru_cache
+
+from prompts import SAFE_STORY_PROMPT
+from utils import gather_with_concurrency
+
+GUARDRAILS_CONFIG_PATH = 'config'
+REFUSAL_MESSAGE = 'refuse to respond'
+CHUNK_SIZE = 4000
+
+@lru_cache(maxsize=None)
+def get_rails(config_path:str = GUARDRAILS_CONFIG_PATH):
+    """Returns the guardrails engine for a config directory, built once per process."""
+    from nemoguardrails import LLMRails, RailsConfig
+    return LLMRails(RailsConfig.from_path(config_path))
+
+def refusals(rails):
+    """Returns the bot messages used by the rails to refuse a story."""
+    return rails.config.bot_messages.get(REFUSAL_MESSAGE, [])
+
+def split_story(story:str, chunk_size:int = CHUNK_SIZE):
+    """Splits a story into chunks of whole sentences of at most chunk_size characters.
+
+    Args:
+        story: story text
+        chunk_size: maximum chunk length, a longer sentence becomes its own chunk
+    Returns:
+        list of chunks
+    """
+    chunks = []
+    chunk = ''
+    for sentence in re.split(r'(?<=[.!?])\s+', story.strip()):
+        if chunk and len(chunk) + len(sentence) + 1 > chunk_size:
+            chunks.append(chunk)
+            chunk = sentence
+        else:
+            chunk = f'{chunk} {sentence}' if chunk else sentence
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+async def make_story_safe(story:str, chunk_size:int = CHUNK_SIZE, max_concurrency:int = 8, config_path:str = GUARDRAILS_CONFIG_PATH):
+    """Rewrites a story to be safe for children and checks it with the output rails.
+
+    Long stories are split into chunks that are rewritten and checked
+    concurrently. If the rails refuse any chunk, the whole story is refused
+    with the same message a single call would return.
+
+    Args:
+        story: story text
+        chunk_size: maximum chunk length in characters
+        max_concurrency: maximum number of chunks checked at the same time
+        config_path: guardrails config directory
+    Returns:
+        tuple of the safe story and whether it was refused
+    """
+    from llama_index.core import PromptTemplate
+    rails = get_rails(config_path)
+    template = PromptTemplate(SAFE_STORY_PROMPT)
+    chunks = split_story(story, chunk_size)
+    results = await gather_with_concurrency(max_concurrency, *(rails.generate_async(prompt=template.format(story=chunk)) for chunk in chunks))
+    results = [str(result).strip() for result in results]
+    refused = [result for result in results if result in refusals(rails)]
+    if refused:
+        return refused[0], True
+    return ' '.join(results), False
@@ -1,33 +1,38 @@
-import requests
+import asyncio
+import random
+import time
 import base64
+import io
 import json
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter
-from reportlab.lib.units import inch
-from reportlab.platypus import Paragraph, Frame
-from reportlab.lib.styles import getSampleStyleSheet
-from reportlab.lib import colors
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from PIL import Image, ImageDraw, ImageFont
 
-from PIL import Image
-import pymupdf
+from cache import cache_key
+from metrics import (measure, add, add_wait)
+from singleflight import single_flight
 
-def generate_image(prompt:str, key:str):
-    """Generates image using StabilityAI diffusion model available as NVidia NIM API.
+NVIDIA_SD3_URL = "https://ai.api.nvidia.com/v1/genai/stabilityai/stable-diffusion-3-medium"
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+#caption layout used by add_text, in PDF points which match image pixels
+CAPTION_FONT_SIZE = 45
+CAPTION_LEADING = 45 * 1.2
+CAPTION_MARGIN = 50
+CAPTION_FONTS = ("Helvetica-Bold.ttf", "Arial Bold.ttf", "Arial_Bold.ttf", "DejaVuSans-Bold.ttf", "LiberationSans-Bold.ttf")
+CAPTION_COLOR = (211, 211, 211)
+
+_flight = single_flight('image')
+
+def image_payload(prompt:str):
+    """Returns request payload for the stable diffusion endpoint.
 
     Args:
         prompt: Image gen prompt
-        key: NVIDIA API Key
     Returns:
-        Generated image in base64 format
+        json payload for the image generation request
     """
-    invoke_url = "https://ai.api.nvidia.com/v1/genai/stabilityai/stable-diffusion-3-medium"
-
-    headers = {
-        "Authorization": f"Bearer {key}",
-        "Accept": "application/json",
-    }
-    
-    payload = {
+    return {
         "prompt": prompt,
         "cfg_scale": 5,
         "aspect_ratio": "16:9",
@@ -35,13 +40,134 @@ def generate_image(prompt:str, key:str):
         "steps": 50,
         "negative_prompt": ""
     }
-    
-    response = requests.post(invoke_url, headers=headers, json=payload)
 
-    response.raise_for_status()
-    response_body = response.json()
-    #print(response_body)
-    return response_body['image']
+def image_headers(key:str):
+    """Returns request headers for the stable diffusion endpoint."""
+    return {
+        "Authorization": f"Bearer {key}",
+        "Accept": "application/json",
+    }
+
+def image_cache_key(prompt:str, invoke_url:str):
+    """Returns image cache key for the prompt, full request payload and model url."""
+    return cache_key('image', invoke_url, image_payload(prompt))
+
+class ImageGenClient:
+    """Async client for the stable diffusion NIM API.
+
+    Requests share a pooled keep-alive connection and at most `max_concurrency`
+    of them are in flight. Throttled (429) or failed (5xx) requests are retried
+    with a backoff shared by all requests, so the whole client slows down when
+    the endpoint pushes back and speeds up again as requests succeed.
+
+    Args:
+        key: NVIDIA API Key
+        invoke_url: image generation endpoint
+        max_concurrency: maximum number of in-flight requests
+        timeout: per-request timeout in seconds
+        max_retries: retries per request before giving up
+        backoff: initial backoff delay in seconds
+        max_backoff: upper bound of the backoff delay in seconds
+        cache: optional DiskCache of raw image bytes checked before calling the endpoint
+    """
+    def __init__(self, key:str, invoke_url:str = NVIDIA_SD3_URL, max_concurrency:int = 4,
+                 timeout:float = 120, max_retries:int = 5, backoff:float = 1, max_backoff:float = 60, cache = None):
+        self.invoke_url = invoke_url
+        self.cache = cache
+        self.max_retries = max_retries
+        self.min_backoff = backoff
+        self.max_backoff = max_backoff
+        self._backoff = backoff
+        self._resume_at = 0.0
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        import httpx
+        self._client = httpx.AsyncClient(
+            headers=image_headers(key),
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency),
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+    async def aclose(self):
+        """Closes pooled connections."""
+        await self._client.aclose()
+
+    def _throttle(self, response):
+        """Pauses all requests after a throttled or failed response."""
+        delay = self._backoff
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, float(retry_after))
+        delay = min(delay * random.uniform(1, 1.5), self.max_backoff)
+        self._resume_at = max(self._resume_at, time.monotonic() + delay)
+        self._backoff = min(self._backoff * 2, self.max_backoff)
+
+    async def _wait_for_resume(self):
+        delay = self._resume_at - time.monotonic()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self._resume_at - time.monotonic()
+
+    async def generate_bytes(self, prompt:str):
+        """Generates image for the prompt, using the image cache when available.
+
+        Args:
+            prompt: Image gen prompt
+        Returns:
+            Generated image bytes
+        """
+        with measure('image.generate') as m:
+            image_key = image_cache_key(prompt, self.invoke_url)
+            if self.cache is not None:
+                image_bytes = self.cache.get(image_key)
+                if image_bytes is not None:
+                    m.add(cache_hits=1)
+                    return image_bytes
+            #identical requests in flight anywhere in the process share one call
+            return await _flight.ado(image_key, self._generate_bytes, image_key, prompt)
+
+    async def _generate_bytes(self, image_key:str, prompt:str):
+        image_bytes = base64.b64decode(await self.generate(prompt))
+        if self.cache is not None:
+            self.cache.set(image_key, image_bytes)
+        return image_bytes
+
+    async def generate(self, prompt:str):
+        """Generates image for the prompt by calling the endpoint.
+
+        Args:
+            prompt: Image gen prompt
+        Returns:
+            Generated image in base64 format
+        """
+        import httpx
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                add(retries=1)
+            start = time.perf_counter()
+            await self._wait_for_resume()
+            async with self._semaphore:
+                add_wait(time.perf_counter() - start)
+                try:
+                    response = await self._client.post(self.invoke_url, json=image_payload(prompt))
+                except httpx.TransportError:
+                    if attempt == self.max_retries:
+                        raise
+                    response = None
+            if response is not None:
+                add(bytes_downloaded=len(response.content))
+            if response is not None and response.status_code not in RETRY_STATUS_CODES:
+                response.raise_for_status()
+                self._backoff = max(self.min_backoff, self._backoff / 2)
+                return response.json()['image']
+            if attempt == self.max_retries:
+                response.raise_for_status()
+            self._throttle(response)
 
 def base64_to_imagefile(data, file:str):
     """Decodes base64 encoded image and saves as an image file.
@@ -57,8 +183,18 @@ def base64_to_imagefile(data, file:str):
     image_bytes = base64.b64decode(base64_image)
 
     # Save the image to a file
+    save_imagefile(image_bytes, file)
+
+def save_imagefile(image_bytes:bytes, file:str):
+    """Saves raw image bytes as an image file.
+
+    Args:
+        image_bytes: encoded image
+        file: output location to save file
+    """
     with open(file, "wb") as image_file:
         image_file.write(image_bytes)
+    add(bytes_written=len(image_bytes))
 
 def json_to_img(file:str):
     """Decodes base64 encoded image from a json file and saves as an image file.
@@ -82,6 +218,7 @@ def generate_image_stability(prompt:str, key:str, file:str):
     Returns:
         Generated image in base64 format
     """
+    import requests
     response = requests.post(
         f"https://api.stability.ai/v2beta/stable-image/generate/sd3",
         headers={
@@ -101,6 +238,29 @@ def generate_image_stability(prompt:str, key:str, file:str):
     else:
         raise Exception(str(response.json()))
 
+#pdf image profiles, images wider than max_width pixels are downsampled and recompressed at the JPEG quality
+#pages keep the size of the title image in points so the layout is the same for every profile
+PDF_PROFILES = {
+    'original': None,
+    'print': {'max_width': None, 'quality': 90},
+    'ebook': {'max_width': 1024, 'quality': 75},
+    'screen': {'max_width': 640, 'quality': 60},
+}
+
+@lru_cache(maxsize=None)
+def caption_style():
+    """Returns the paragraph style of page captions, built once and shared by all pages."""
+    from reportlab.lib import colors
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    return ParagraphStyle(
+        'Caption',
+        parent=getSampleStyleSheet()["Normal"],
+        fontSize=CAPTION_FONT_SIZE,
+        fontName="Helvetica-Bold",
+        leading=CAPTION_LEADING,
+        textColor=colors.lightgrey,
+    )
+
 def add_text(c, text, width, height, is_right = False):
     """Adds text to a given frame in the PDF page
 
@@ -111,21 +271,12 @@ def add_text(c, text, width, height, is_right = False):
         height: height of the page
         is_right: flag to align the text to left or right side of the page
     """
+    from reportlab.platypus import Paragraph
     # Define the box dimensions and position
     x, y, w, h = 10, 10, 0.5 * width, 0.5*height
 
-    # Create a Frame for the text
-    #frame = Frame(x, y, w, h, showBoundary=0) 
-
-    # Create a Paragraph style
-    styles = getSampleStyleSheet()
-    style = styles["Normal"]
-    style.fontSize = 45
-    style.fontName = "Helvetica-Bold"
-    style.leading = 45 * 1.2
-    style.textColor = colors.lightgrey
     # Create a Paragraph object with the text
-    p = Paragraph(text, style)
+    p = Paragraph(text, caption_style())
     
     # Draw the paragraph on the canvas
     p.wrapOn(c, 0.5 * width, 100)
@@ -134,32 +285,60 @@ def add_text(c, text, width, height, is_right = False):
     else:
         p.drawOn(c, 0.5 * width - 50, h - 50)   
 
-def create_pdf(filename, data, img_path):
+def optimize_image(img_file:str, max_width:int = None, quality:int = 75):
+    """Downsamples and recompresses an image for embedding in a PDF.
+
+    Args:
+        img_file: image file
+        max_width: maximum width in pixels, None keeps the size
+        quality: JPEG quality
+    Returns:
+        ImageReader of the JPEG encoded image
+    """
+    from reportlab.lib.utils import ImageReader
+    with Image.open(img_file) as img:
+        img = img.convert('RGB')
+        if max_width and img.width > max_width:
+            img = img.resize((max_width, round(img.height * max_width / img.width)), Image.LANCZOS)
+        buf = io.BytesIO()
+        img.save(buf, 'JPEG', quality=quality, optimize=True)
+    buf.seek(0)
+    return ImageReader(buf)
+
+def create_pdf(filename, data, img_path, profile:str = 'original', max_workers:int = None):
     """Creates a story PDF by combining image and text to generate pages
 
     Args:
         filename: output file name
         data: object of type ChildrenStory data model
         img_path: Directory where images are stored
+        profile: name of a PDF_PROFILES entry, 'original' embeds the images as they are
+        max_workers: maximum number of images optimized at the same time
     """
+    from reportlab.pdfgen import canvas
     # Open the title image and get its dimensions
     title_img = f'{img_path}/title.jpg'
     with Image.open(title_img) as img:
         width, height = img.size
+    images = [title_img] + [f"{img_path}/{page_data.page_no}.jpg" for page_data in data.pages]
+    settings = PDF_PROFILES[profile]
+    if settings is not None:
+        #downsample and recompress all images in parallel, PIL releases the GIL while encoding
+        with ThreadPoolExecutor(max_workers) as executor:
+            images = list(executor.map(lambda img_file: optimize_image(img_file, **settings), images))
 
     # Create a PDF canvas based on the title image size
     c = canvas.Canvas(filename, pagesize=(width, height))
 
     # Draw the title image on the canvas
-    c.drawImage(title_img, 0, 0, width, height)
+    c.drawImage(images[0], 0, 0, width, height)
     # Add page break
     c.showPage()
     #initiate with left alignment
     right_align  = False
     #draw all pages
-    for page_data in data.pages:
-        #get image and text for the page
-        page_img = f"{img_path}/{page_data.page_no}.jpg"
+    for page_data, page_img in zip(data.pages, images[1:]):
+        #get text for the page
         page_text = page_data.content
         #draw image and text
         c.drawImage(page_img, 0, 0, width, height)
@@ -171,15 +350,69 @@ def create_pdf(filename, data, img_path):
     #save file
     c.save()
 
-def pdf_to_image(pdf_path, output_folder):
-    """Exports pdf pages to an image file
+@lru_cache(maxsize=None)
+def caption_font(size:int):
+    """Returns a bold font for captions, falling back to the default PIL font."""
+    for name in CAPTION_FONTS:
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            continue
+    return ImageFont.load_default(size)
+
+def wrap_text(text:str, font, max_width:float):
+    """Splits text into lines that fit within max_width."""
+    lines = []
+    line = ''
+    for word in text.split():
+        candidate = f'{line} {word}' if line else word
+        if line and font.getlength(candidate) > max_width:
+            lines.append(line)
+            line = word
+        else:
+            line = candidate
+    if line:
+        lines.append(line)
+    return lines
+
+def draw_caption(image, text:str, is_right:bool = False, scale:float = 1):
+    """Draws page text on an image with the same layout as add_text.
 
     Args:
-        pdf_path: location of the pdf file
-        output_folder: location of output images
+        image: PIL image to draw on
+        text: Text to be added
+        is_right: flag to align the text to left or right side of the page
+        scale: ratio of the image size to the size of the generated image
+    """
+    width, height = image.size
+    font = caption_font(round(CAPTION_FONT_SIZE * scale))
+    leading = CAPTION_LEADING * scale
+    margin = CAPTION_MARGIN * scale
+    lines = wrap_text(text, font, 0.5 * width)
+    #add_text places the bottom of the paragraph at half the page height minus the margin, from the bottom
+    bottom = height - (0.5 * height - margin)
+    top = bottom - len(lines) * leading
+    x = margin if is_right else 0.5 * width - margin
+    draw = ImageDraw.Draw(image)
+    for i, line in enumerate(lines):
+        draw.text((x, top + i * leading + font.size), line, font=font, fill=CAPTION_COLOR, anchor='ls')
+
+def compose_frame(img_file:str, out_file:str, text:str = None, is_right:bool = False, size = None):
+    """Composes a video frame from a generated image and its page text.
+
+    Args:
+        img_file: generated image
+        out_file: output frame image
+        text: page text, None for the title page
+        is_right: flag to align the text to left or right side of the page
+        size: frame size as (width, height), defaults to the image size
     """
-    doc = pymupdf.open(pdf_path)
-    for page in doc:
-        p = doc.load_page(page.number)
-        pix = p.get_pixmap()
-        pix.save(f"{output_folder}/{page.number}.png")
+    with Image.open(img_file) as img:
+        frame = img.convert('RGB')
+    scale = 1
+    if size is not None and tuple(size) != frame.size:
+        scale = size[0] / frame.size[0]
+        frame = frame.resize(tuple(size), Image.LANCZOS)
+    if text:
+        draw_caption(frame, text, is_right, scale)
+    frame.save(out_file)
@@ -0,0 +1,94 @@
+import logging
+
+from pydantic import ValidationError
+
+from models import ChildrenStoryPrompt
+from prompts import STORY_BATCH_GENERATE_IMAGE_PROMPT
+from utils import gather_with_concurrency
+
+WINDOW_TOKENS = 3000
+WINDOW_PAGES = 16
+
+logger = logging.getLogger(__name__)
+
+def prompt_windows(story, numbers, max_tokens:int = WINDOW_TOKENS, max_pages:int = WINDOW_PAGES):
+    """Groups pages into windows that fit one batched prompt call.
+
+    Args:
+        story: ChildrenStory object
+        numbers: page numbers to group, 0 being the title page
+        max_tokens: maximum number of page text tokens in a window
+        max_pages: maximum number of pages in a window, which bounds the response length
+    Returns:
+        list of lists of page numbers, the title page is asked for in the first window
+    """
+    from llama_index.core.utils import get_tokenizer
+    tokenizer = get_tokenizer()
+    windows = [[]]
+    tokens = 0
+    for number in sorted(n for n in numbers if n > 0):
+        page_tokens = len(tokenizer(story.pages[number - 1].content))
+        if windows[-1] and (tokens + page_tokens > max_tokens or len(windows[-1]) >= max_pages):
+            windows.append([])
+            tokens = 0
+        windows[-1].append(number)
+        tokens += page_tokens
+    if 0 in numbers:
+        windows[0].insert(0, 0)
+    return [window for window in windows if window]
+
+def window_story(story, window):
+    """Returns title and the text of the window pages, labelled with their page numbers."""
+    lines = [f'Title : {story.title}']
+    lines += [f'Page {story.pages[number - 1].page_no} : {story.pages[number - 1].content}' for number in window if number > 0]
+    return '\n'.join(lines)
+
+async def generate_window_prompts(story, window, llm = None):
+    """Generates image prompts of a window of pages with one structured call.
+
+    Args:
+        story: ChildrenStory object
+        window: page numbers, 0 being the title page
+        llm: LLM to call, defaults to Settings.llm
+    Returns:
+        dictionary of page number to prompt, pages with a missing or invalid prompt are left out
+    """
+    from llama_index.core.output_parsers import PydanticOutputParser
+    from llama_index.core.program import LLMTextCompletionProgram
+    program = LLMTextCompletionProgram.from_defaults(
+        output_parser=PydanticOutputParser(output_cls=ChildrenStoryPrompt),
+        prompt_template_str=STORY_BATCH_GENERATE_IMAGE_PROMPT,
+        llm=llm,
+    )
+    page_nos = {story.pages[number - 1].page_no: number for number in window if number > 0}
+    try:
+        output:ChildrenStoryPrompt = await program.acall(pages=', '.join(str(page_no) for page_no in page_nos), story=window_story(story, window))
+    except (ValueError, ValidationError) as e:
+        #the pages of an unparsable response fall back to per page generation, request errors are raised
+        logger.warning('Batched prompts of pages %s fall back to per page generation: %s', window, e)
+        return {}
+    prompts = {page_nos[p.page_no]: p.prompt.strip() for p in output.prompts if p.page_no in page_nos and p.prompt.strip()}
+    if 0 in window and output.title_prompt.strip():
+        prompts[0] = output.title_prompt.strip()
+    return prompts
+
+async def generate_prompts_batched(story, numbers, llm = None, max_tokens:int = WINDOW_TOKENS,
+                                   max_pages:int = WINDOW_PAGES, max_concurrency:int = 8):
+    """Generates image prompts of many pages with one structured call per window of pages.
+
+    Every page text is sent once instead of the whole book being sent for
+    every page, so token cost grows linearly with the book length.
+
+    Args:
+        story: ChildrenStory object
+        numbers: page numbers to generate prompts for, 0 being the title page
+        llm: LLM to call, defaults to Settings.llm
+        max_tokens: maximum number of page text tokens in a call
+        max_pages: maximum number of pages in a call
+        max_concurrency: maximum number of in-flight calls
+    Returns:
+        dictionary of page number to prompt, failed pages are left out for per page generation
+    """
+    windows = prompt_windows(story, numbers, max_tokens, max_pages)
+    results = await gather_with_concurrency(max_concurrency, *(generate_window_prompts(story, window, llm) for window in windows))
+    return {number: prompt for result in results for number, prompt in result.items()}
@@ -0,0 +1,157 @@
+import time
+from typing import Any, Optional, Sequence
+
+from llama_index.core.base.llms.types import (ChatMessage, ChatResponse, CompletionResponse, CompletionResponseAsyncGen)
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.llms.nvidia import NVIDIA
+from langchain_core.caches import BaseCache
+from langchain_core.load import dumps, loads
+
+from cache import DiskCache, cache_key
+from metrics import (measure, record_call, add)
+from singleflight import single_flight
+
+_flight = single_flight('llm')
+
+def token_counts(response):
+    """Returns prompt and completion token counts reported with an LLM response."""
+    counts = response.additional_kwargs or {}
+    usage = getattr(response.raw, 'usage', None) if response.raw is not None else None
+    if not counts and usage is not None:
+        counts = {'prompt_tokens': usage.prompt_tokens, 'completion_tokens': usage.completion_tokens}
+    return {'prompt_tokens': counts.get('prompt_tokens', 0) or 0, 'completion_tokens': counts.get('completion_tokens', 0) or 0}
+
+class CachedNVIDIA(NVIDIA):
+    """NVIDIA LLM with completions served from a persistent cache.
+
+    Cache entries are keyed by model name, a hash of the prompt or chat
+    messages and the sampling parameters. Async completion streams are cached
+    once they finish and replayed as a single chunk, other streaming calls
+    are not cached. Concurrent identical calls of the whole process share
+    one request, streams excepted.
+    Calls are measured with cache hits and the token usage of the endpoint.
+    The request helpers are named apart from the private `_complete` and
+    `_chat` methods of the OpenAI base class, which its public methods call.
+
+    Args:
+        cache: completion cache, None disables caching
+    """
+    _cache: Optional[DiskCache] = PrivateAttr(default=None)
+
+    def __init__(self, cache:Optional[DiskCache] = None, **kwargs: Any):
+        super().__init__(**kwargs)
+        self._cache = cache
+
+    def _key(self, kind:str, prompt, kwargs:dict):
+        params = {
+            'temperature': getattr(self, 'temperature', None),
+            'max_tokens': getattr(self, 'max_tokens', None),
+            **(getattr(self, 'additional_kwargs', None) or {}),
+            **kwargs,
+        }
+        return cache_key(kind, self.model, cache_key(prompt), params)
+
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        with measure('llm.complete') as m:
+            key = self._key('complete', prompt, kwargs)
+            cached = self._cache.get_json(key) if self._cache is not None else None
+            if cached is not None:
+                m.add(cache_hits=1)
+                return CompletionResponse(text=cached['text'])
+            return _flight.do(key, self._fetch_completion, key, prompt, formatted, kwargs)
+
+    def _fetch_completion(self, key, prompt, formatted, kwargs):
+        response = super().complete(prompt, formatted=formatted, **kwargs)
+        add(**token_counts(response))
+        if self._cache is not None:
+            self._cache.set_json(key, {'text': response.text})
+        return response
+
+    async def acomplete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        with measure('llm.complete') as m:
+            key = self._key('complete', prompt, kwargs)
+            cached = self._cache.get_json(key) if self._cache is not None else None
+            if cached is not None:
+                m.add(cache_hits=1)
+                return CompletionResponse(text=cached['text'])
+            return await _flight.ado(key, self._afetch_completion, key, prompt, formatted, kwargs)
+
+    async def _afetch_completion(self, key, prompt, formatted, kwargs):
+        response = await super().acomplete(prompt, formatted=formatted, **kwargs)
+        add(**token_counts(response))
+        if self._cache is not None:
+            self._cache.set_json(key, {'text': response.text})
+        return response
+
+    async def astream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponseAsyncGen:
+        key = self._key('complete', prompt, kwargs) if self._cache is not None else None
+        cached = self._cache.get_json(key) if key is not None else None
+        stream = None if cached is not None else await super().astream_complete(prompt, formatted=formatted, **kwargs)
+
+        async def gen() -> CompletionResponseAsyncGen:
+            start = time.perf_counter()
+            if cached is not None:
+                record_call('llm.stream_complete', time.perf_counter() - start, cache_hits=1)
+                yield CompletionResponse(text=cached['text'], delta=cached['text'])
+                return
+            response = None
+            async for response in stream:
+                yield response
+            record_call('llm.stream_complete', time.perf_counter() - start, **(token_counts(response) if response is not None else {}))
+            if response is not None and key is not None:
+                self._cache.set_json(key, {'text': response.text})
+        return gen()
+
+    def chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        with measure('llm.chat') as m:
+            key = self._key('chat', [(message.role.value, message.content) for message in messages], kwargs)
+            cached = self._cache.get_json(key) if self._cache is not None else None
+            if cached is not None:
+                m.add(cache_hits=1)
+                return ChatResponse(message=ChatMessage(role=cached['role'], content=cached['content']))
+            return _flight.do(key, self._fetch_chat, key, messages, kwargs)
+
+    def _fetch_chat(self, key, messages, kwargs):
+        response = super().chat(messages, **kwargs)
+        add(**token_counts(response))
+        if self._cache is not None:
+            self._cache.set_json(key, {'role': response.message.role.value, 'content': response.message.content})
+        return response
+
+    async def achat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        with measure('llm.chat') as m:
+            key = self._key('chat', [(message.role.value, message.content) for message in messages], kwargs)
+            cached = self._cache.get_json(key) if self._cache is not None else None
+            if cached is not None:
+                m.add(cache_hits=1)
+                return ChatResponse(message=ChatMessage(role=cached['role'], content=cached['content']))
+            return await _flight.ado(key, self._afetch_chat, key, messages, kwargs)
+
+    async def _afetch_chat(self, key, messages, kwargs):
+        response = await super().achat(messages, **kwargs)
+        add(**token_counts(response))
+        if self._cache is not None:
+            self._cache.set_json(key, {'role': response.message.role.value, 'content': response.message.content})
+        return response
+
+class GuardrailsLLMCache(BaseCache):
+    """LangChain cache backed by a DiskCache, used by the NeMo Guardrails LLM.
+
+    LangChain passes a string describing the model and its parameters along
+    with the prompt, so entries are keyed by both.
+
+    Args:
+        cache: completion cache
+    """
+    def __init__(self, cache:DiskCache):
+        self._cache = cache
+
+    def lookup(self, prompt: str, llm_string: str):
+        cached = self._cache.get(cache_key('langchain', llm_string, cache_key(prompt)))
+        return None if cached is None else loads(cached.decode('utf-8'))
+
+    def update(self, prompt: str, llm_string: str, return_val):
+        self._cache.set(cache_key('langchain', llm_string, cache_key(prompt)), dumps(return_val).encode('utf-8'))
+
+    def clear(self, **kwargs: Any):
+        """Entries are shared with other caches and expire through LRU eviction."""
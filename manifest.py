@@ -0,0 +1,60 @@
+import json
+import os
+import threading
+
+from cache import cache_key
+
+MANIFEST_FILE = 'manifest.json'
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+def input_hash(*inputs):
+    """Returns hash of the inputs an artifact is built from."""
+    return cache_key(*inputs)
+
+class Manifest:
+    """Records artifacts generated in a workspace with a hash of their inputs.
+
+    Artifacts are named by their path relative to the workspace. An artifact
+    is fresh when its file exists and it was recorded with the same input
+    hash, so only stale artifacts need to be rebuilt. Hashes of recorded
+    artifacts are used as inputs of the artifacts built from them, which makes
+    changes propagate down the dependency graph.
+
+    Args:
+        workspace: workspace directory
+    """
+    def __init__(self, workspace:str):
+        self.workspace = workspace
+        self.file = os.path.join(workspace, MANIFEST_FILE)
+        self._lock = threading.Lock()
+        self._entries = {}
+        if os.path.isfile(self.file):
+            with open(self.file, 'r', encoding='utf-8') as f:
+                self._entries = json.load(f)
+
+    def get(self, name:str):
+        """Returns recorded input hash of an artifact or None."""
+        return self._entries.get(name)
+
+    def is_fresh(self, name:str, inputs:str):
+        """Checks if an artifact exists and was built from the given inputs."""
+        return self._entries.get(name) == inputs and os.path.isfile(os.path.join(self.workspace, name))
+
+    def record(self, name:str, inputs:str):
+        """Records an artifact built from the given inputs."""
+        with self._lock:
+            self._entries[name] = inputs
+            tmp_file = f'{self.file}.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(self._entries, f, indent=2, sort_keys=True)
+            os.replace(tmp_file, self.file)
+
+def load_manifest(workspace:str):
+    """Returns the manifest of a workspace, shared by all steps of the process."""
+    key = os.path.abspath(workspace)
+    with _manifests_lock:
+        if key not in _manifests:
+            _manifests[key] = Manifest(workspace)
+        return _manifests[key]
@@ -0,0 +1,207 @@
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+METRICS_JSON_FILE = 'metrics.json'
+METRICS_PROM_FILE = 'metrics.prom'
+METRICS_PREFIX = 'storygen'
+COUNTERS = ('retries', 'cache_hits', 'coalesced_calls', 'prompt_tokens', 'completion_tokens', 'bytes_downloaded', 'bytes_written')
+
+_active = contextvars.ContextVar('active_measurement', default=None)
+
+class Measurement:
+    """Wall time, queue wait and counters of one step or external call.
+
+    Args:
+        name: step or call name
+        kind: 'step' or 'call'
+        collector: RunMetrics receiving the measurement, None to discard it
+    """
+    def __init__(self, name:str, kind:str, collector = None):
+        self.name = name
+        self.kind = kind
+        self.collector = collector
+        self.wall = 0.0
+        self.wait = 0.0
+        self.error = False
+        self.counts = dict.fromkeys(COUNTERS, 0)
+
+    def add(self, **counts):
+        """Adds to the counters of the measurement."""
+        for name, value in counts.items():
+            self.counts[name] += value
+
+class RunMetrics:
+    """Collects measurements of one workflow run and reports them.
+
+    Measurements are aggregated by kind and name. Steps and the calls they
+    make are reported separately so the time of a call is not counted twice,
+    while counters are summed over all measurements for the run totals.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, m:Measurement):
+        """Adds a finished measurement."""
+        with self._lock:
+            stats = self._stats.setdefault((m.kind, m.name), {
+                'count': 0, 'errors': 0, 'wall_seconds': 0.0, 'max_wall_seconds': 0.0, 'wait_seconds': 0.0,
+                **dict.fromkeys(COUNTERS, 0),
+            })
+            stats['count'] += 1
+            stats['errors'] += int(m.error)
+            stats['wall_seconds'] += m.wall
+            stats['max_wall_seconds'] = max(stats['max_wall_seconds'], m.wall)
+            stats['wait_seconds'] += m.wait
+            for name, value in m.counts.items():
+                stats[name] += value
+
+    def report(self):
+        """Returns the run report as a dictionary."""
+        with self._lock:
+            stats = {key: dict(value) for key, value in self._stats.items()}
+        report = {
+            'started': self.started,
+            'wall_seconds': round(time.perf_counter() - self._start, 6),
+            'totals': {name: sum(s[name] for s in stats.values()) for name in COUNTERS},
+            'steps': {},
+            'calls': {},
+        }
+        for (kind, name), s in sorted(stats.items()):
+            for field in ('wall_seconds', 'max_wall_seconds', 'wait_seconds'):
+                s[field] = round(s[field], 6)
+            report[f'{kind}s'][name] = s
+        return report
+
+    def prometheus(self):
+        """Returns the run report in the Prometheus text exposition format."""
+        report = self.report()
+        lines = [
+            f'# HELP {METRICS_PREFIX}_run_seconds Wall time of the run',
+            f'# TYPE {METRICS_PREFIX}_run_seconds gauge',
+            f'{METRICS_PREFIX}_run_seconds {report["wall_seconds"]}',
+        ]
+        families = [
+            ('count', 'calls_total', 'counter', 'Number of step runs or external calls'),
+            ('errors', 'errors_total', 'counter', 'Number of step runs or external calls that raised'),
+            ('wall_seconds', 'wall_seconds_total', 'counter', 'Wall time'),
+            ('max_wall_seconds', 'max_wall_seconds', 'gauge', 'Longest single wall time'),
+            ('wait_seconds', 'wait_seconds_total', 'counter', 'Time spent waiting for a concurrency slot or worker'),
+        ] + [(name, f'{name}_total', 'counter', name.replace('_', ' ').capitalize()) for name in COUNTERS]
+        for field, metric, metric_type, help_text in families:
+            lines.append(f'# HELP {METRICS_PREFIX}_{metric} {help_text}')
+            lines.append(f'# TYPE {METRICS_PREFIX}_{metric} {metric_type}')
+            for kind in ('step', 'call'):
+                for name, s in report[f'{kind}s'].items():
+                    lines.append(f'{METRICS_PREFIX}_{metric}{{kind="{kind}",name="{name}"}} {s[field]}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, workspace:str):
+        """Writes the JSON report and the Prometheus exposition to the workspace.
+
+        Args:
+            workspace: workspace directory of the run
+        Returns:
+            paths of the JSON and Prometheus files
+        """
+        json_file = os.path.join(workspace, METRICS_JSON_FILE)
+        prom_file = os.path.join(workspace, METRICS_PROM_FILE)
+        with open(json_file, 'w', encoding='utf-8') as f:
+            json.dump(self.report(), f, indent=2)
+        with open(prom_file, 'w', encoding='utf-8') as f:
+            f.write(self.prometheus())
+        return json_file, prom_file
+
+@contextmanager
+def measure(name:str, kind:str = 'call', collector:RunMetrics = None):
+    """Measures the enclosed block as a step or an external call.
+
+    The measurement is reported to the collector of the enclosing measurement
+    unless one is given, so calls made anywhere inside a step, including
+    threads started with asyncio.to_thread, end up in the report of the run.
+
+    Args:
+        name: step or call name
+        kind: 'step' or 'call'
+        collector: RunMetrics of the run, defaults to the enclosing one
+    Returns:
+        the Measurement, to add counters to
+    """
+    parent = _active.get()
+    if collector is None and parent is not None:
+        collector = parent.collector
+    m = Measurement(name, kind, collector)
+    token = _active.set(m)
+    start = time.perf_counter()
+    try:
+        yield m
+    except BaseException:
+        m.error = True
+        raise
+    finally:
+        m.wall = time.perf_counter() - start
+        _active.reset(token)
+        if collector is not None:
+            collector.record(m)
+
+def record_call(name:str, seconds:float, **counts):
+    """Records an external call timed by the caller to the run of the enclosing measurement.
+
+    For calls that span several resumptions of a generator, where the
+    measure context manager cannot be held.
+    """
+    parent = _active.get()
+    if parent is not None and parent.collector is not None:
+        m = Measurement(name, 'call', parent.collector)
+        m.wall = seconds
+        m.add(**counts)
+        parent.collector.record(m)
+
+def add(**counts):
+    """Adds to the counters of the enclosing measurement, if any."""
+    m = _active.get()
+    if m is not None:
+        m.add(**counts)
+
+def add_wait(seconds:float):
+    """Adds queue wait time to the enclosing measurement, if any."""
+    m = _active.get()
+    if m is not None:
+        m.wait += seconds
+
+@asynccontextmanager
+async def acquire(semaphore):
+    """Holds a semaphore and records the time spent waiting for it."""
+    start = time.perf_counter()
+    async with semaphore:
+        add_wait(time.perf_counter() - start)
+        yield
+
+def file_size(file:str):
+    """Returns size of a file in bytes, 0 when it does not exist."""
+    try:
+        return os.path.getsize(file)
+    except OSError:
+        return 0
+
+def call_started(func, *args):
+    """Runs a function and returns the wall clock time it started with its result.
+
+    Used to measure how long a job waited in an executor queue, also across processes.
+    """
+    return time.time(), func(*args)
+
+def measure_step(func):
+    """Decorates a workflow step to measure it into the `metrics` of the workflow."""
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        with measure(func.__name__, 'step', self.metrics):
+            return await func(self, *args, **kwargs)
+    return wrapper
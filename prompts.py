@@ -35,4 +35,40 @@ EXTRACT_SUMMARIZE_STORY_PROMPT = "extract the story from documents"
 SAFE_STORY_PROMPT = """
 Rewrite story to make it safe for children. 
 \n\n Story: ''{story}'''
-"""
\ No newline at end of file
+"""
+
+SUMMARIZE_CHUNK_PROMPT = """
+{query}. The text below is one part of a longer document.
+Only return the story found in this part. Return an empty response if there is none.
+\n\n Text: '''{text}'''
+"""
+
+COMBINE_SUMMARIES_PROMPT = """
+{query}. The texts below are consecutive parts of the same story.
+Combine them into a single story that keeps the order of events.
+\n\n Parts: '''{text}'''
+"""
+
+STORY_BATCH_GENERATE_IMAGE_PROMPT = """
+You are an AI agent that generates prompts that can be passed to image generation multimodal LLM.
+You are given a children's book with a title and page content of the book.
+Your job is to create a prompt to generate fun and engaging title page for the book
+and a prompt to generate fun and engaging pictures for each of the pages {pages} in the book.
+Make sure name/character used is fully described in each prompt. 
+e.g. Instead of saying Annie is walking slowly, say Annie the crocodile is walking slowly.
+Similarly instead of saying John is curious, say John, 5 year old boy, is curious.
+Respond with a valid JSON. Do not add any sentence before or after the JSON object.
+  \n\n Here is the story: \n
+  ''{story}'''
+"""
+
+STORY_JSON_CONTINUE_PROMPT = """
+Generate a title and list of pages for the story provided.
+Make sure each page is 1 sentence long.
+The title and the first pages were already generated. Only return the remaining pages of the story, starting with page_no {next_page}.
+Keep the title if one is given. Return an empty list of pages if the story is already complete.
+Respond with a valid JSON object with a "title" and a "pages" list. Do not add any sentence before or after the JSON object.
+  \n\n Title: '''{title}'''.
+  \n\n Pages already generated: '''{pages}'''.
+  \n\n Original story: '''{story}'''.
+"""
@@ -0,0 +1,464 @@
+import asyncio
+import itertools
+import json
+import os
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from importlib import import_module
+
+from workflows.events import StepState, StepStateChanged
+
+from batch import job_workspace
+from cache import bypass_cache
+from events import PageProgressEvent
+from singleflight import single_flight_stats
+from utils import init_workspace
+
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 8750
+QUEUE_SIZE = 64
+JOB_HISTORY = 1024
+MAX_REQUEST_BYTES = 1024 * 1024
+
+#job options and the workflow attributes they override
+JOB_OPTIONS = {
+    'test': 'test_mode',
+    'pdf': 'create_pdf',
+    'renderer': 'renderer',
+    'pdf_profile': 'pdf_profile',
+    'video_only': 'video_only',
+    'stream_json': 'stream_json',
+    'batch_prompts': 'batch_prompts',
+}
+
+#modules the workflow steps import on first use, loaded before the first job instead
+WARM_MODULES = (
+    'llama_index.core',
+    'llama_index.core.node_parser',
+    'llama_index.core.output_parsers',
+    'llama_index.core.program',
+    'reportlab.pdfgen.canvas',
+    'reportlab.platypus',
+    'pymupdf',
+    'httpx',
+    'gtts',
+)
+
+HTTP_REASONS = {200: 'OK', 202: 'Accepted', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                409: 'Conflict', 413: 'Payload Too Large', 429: 'Too Many Requests', 500: 'Internal Server Error'}
+
+class HTTPError(Exception):
+    """Error answered to the client with its status code."""
+    def __init__(self, status:int, message:str):
+        super().__init__(message)
+        self.status = status
+
+class Job:
+    """A story job of the server with the progress events of its run.
+
+    Jobs take the fields of batch jobs, a `url`, the story text in `body` or
+    a pdf `file`, along with an optional `priority`, `options` overriding
+    the workflow settings listed in JOB_OPTIONS and `no_cache`. A job with a
+    `request_id` works in the workspace of that id like a batch job does, so
+    a resubmitted job reuses what its previous runs generated.
+
+    Args:
+        job_id: id of the job
+        request: job dictionary
+        workspace: workspace directory of the job
+    """
+    def __init__(self, job_id:str, request:dict, workspace:str):
+        self.id = job_id
+        self.request = request
+        self.priority = int(request.get('priority', 0))
+        self.workspace = workspace
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.handler = None
+        self.events = []
+        self._changed = asyncio.Condition()
+
+    @property
+    def done(self):
+        return self.status in ('ok', 'error', 'cancelled')
+
+    def record(self):
+        """Returns the job status as a dictionary."""
+        record = {'id': self.id, 'request_id': self.request.get('request_id'), 'priority': self.priority, 'status': self.status,
+                  'workspace': self.workspace, 'created': self.created, 'events': len(self.events)}
+        if self.started is not None:
+            record['queued_seconds'] = round(self.started - self.created, 6)
+        if self.finished is not None:
+            record['seconds'] = round(self.finished - (self.started or self.finished), 6)
+        if self.result is not None:
+            record['result'] = self.result
+        if self.error is not None:
+            record['error'] = self.error
+        return record
+
+    async def publish(self, event:dict):
+        """Adds a progress event and wakes up the clients following the job."""
+        self.events.append({'time': time.time(), **event})
+        async with self._changed:
+            self._changed.notify_all()
+
+    async def finish(self, status:str, result:str = None, error:str = None):
+        """Records the outcome of the job and publishes it as the last event."""
+        self.finished = time.time()
+        self.status, self.result, self.error = status, result, error
+        await self.publish({'event': 'finished', **self.record()})
+
+    async def follow(self):
+        """Yields the progress events of the job from the first one until the job is finished.
+
+        Returns:
+            async generator of event dictionaries
+        """
+        index = 0
+        while True:
+            while index < len(self.events):
+                yield self.events[index]
+                index += 1
+            if self.done:
+                return
+            async with self._changed:
+                await self._changed.wait_for(lambda: index < len(self.events) or self.done)
+
+def event_class_name(name:str):
+    """Returns the bare class name of an event type name such as "<class 'events.PageEvent'>"."""
+    return name.rsplit('.', 1)[-1].rstrip("'>") if name else name
+
+def progress_event(ev):
+    """Returns the progress event of an event of the workflow stream, None for events not reported."""
+    if isinstance(ev, StepStateChanged) and ev.step_state != StepState.PREPARING:
+        return {'event': 'step', 'step': ev.name, 'state': ev.step_state.value,
+                'input': event_class_name(ev.input_event_name), 'output': event_class_name(ev.output_event_name)}
+    if isinstance(ev, PageProgressEvent):
+        return {'event': 'page', 'number': ev.number, 'total': ev.total}
+    return None
+
+class StoryServer:
+    """Runs story jobs from a bounded priority queue in a long running process.
+
+    The workflows of all jobs share the clients, caches and process pool set
+    up once by make_workflow and the server, so a job costs a workflow run
+    and nothing else. Jobs with a higher priority are started first, jobs
+    of the same priority in submission order. Jobs submitted while the queue
+    is full are refused rather than delaying every queued job further.
+
+    Args:
+        make_workflow: callable returning a configured workflow
+        root: workspace directory, each job gets a sub directory
+        concurrency: number of jobs running at the same time
+        queue_size: maximum number of queued jobs
+        executor: process pool for CPU bound steps
+    """
+    def __init__(self, make_workflow, root:str, concurrency:int = 4, queue_size:int = QUEUE_SIZE, executor = None):
+        self.make_workflow = make_workflow
+        self.root = root
+        self.executor = executor
+        #capacity is checked against the queued counter since cancelled jobs stay in the queue until a worker skips them
+        self.queue = asyncio.PriorityQueue()
+        self.queue_size = max(1, queue_size)
+        self.jobs = {}
+        self.concurrency = 0
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.started = time.time()
+        self._order = itertools.count()
+        self._workers = 0
+        self._tasks = set()
+        self.set_concurrency(concurrency)
+
+    def set_concurrency(self, concurrency:int):
+        """Changes the number of jobs running at the same time.
+
+        More workers start right away, extra workers stop as their jobs finish.
+        """
+        self.concurrency = max(1, concurrency)
+        while self._workers < self.concurrency:
+            self._workers += 1
+            task = asyncio.get_running_loop().create_task(self._work())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def submit(self, request:dict):
+        """Queues a job.
+
+        Args:
+            request: job dictionary
+        Returns:
+            the queued Job
+        """
+        if not any(request.get(source) for source in ('url', 'body', 'file')):
+            raise HTTPError(400, 'A job needs a url, a body or a file')
+        if not isinstance(request.get('priority', 0), int):
+            raise HTTPError(400, 'priority must be an integer')
+        unknown = set(request.get('options', {})) - set(JOB_OPTIONS)
+        if unknown:
+            raise HTTPError(400, f'Unknown options: {", ".join(sorted(unknown))}')
+        job_id = uuid.uuid4().hex[:12]
+        workspace = job_workspace(self.root, request.get('request_id') or job_id)
+        if any(job.workspace == workspace and not job.done for job in self.jobs.values()):
+            raise HTTPError(409, f'A job of {request["request_id"]} is already queued or running')
+        if self.queued >= self.queue_size:
+            raise HTTPError(429, f'Queue is full with {self.queued} jobs')
+        job = Job(job_id, request, workspace)
+        self.queue.put_nowait((-job.priority, next(self._order), job))
+        self.queued += 1
+        self.jobs[job_id] = job
+        self._forget()
+        return job
+
+    async def cancel(self, job:Job):
+        """Cancels a queued or running job."""
+        if job.done:
+            raise HTTPError(409, f'Job is {job.status}')
+        if job.status == 'queued':
+            self.queued -= 1
+            await job.finish('cancelled')
+        elif job.handler is not None:
+            await job.handler.cancel_run()
+
+    def stats(self):
+        """Returns queue depth, concurrency and job counts of the server."""
+        return {
+            'queued': self.queued,
+            'running': self.running,
+            'concurrency': self.concurrency,
+            'queue_size': self.queue_size,
+            'completed': self.completed,
+            'failed': self.failed,
+            'uptime_seconds': round(time.time() - self.started, 3),
+            'single_flight': single_flight_stats(),
+        }
+
+    def _forget(self):
+        """Drops the oldest finished jobs beyond JOB_HISTORY."""
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.done][:max(0, len(self.jobs) - JOB_HISTORY)]:
+            del self.jobs[job_id]
+
+    async def _work(self):
+        while True:
+            if self._workers > self.concurrency:
+                self._workers -= 1
+                return
+            _, _, job = await self.queue.get()
+            if job.status != 'queued':
+                continue
+            self.queued -= 1
+            self.running += 1
+            try:
+                await self._run(job)
+            finally:
+                self.running -= 1
+
+    async def _run(self, job:Job):
+        """Runs the workflow of a job and publishes its progress."""
+        job.status = 'running'
+        job.started = time.time()
+        await job.publish({'event': 'started', 'queued_seconds': round(job.started - job.created, 6)})
+        request = job.request
+        w = self.make_workflow()
+        w.executor = self.executor
+        for name, value in request.get('options', {}).items():
+            setattr(w, JOB_OPTIONS[name], value)
+        try:
+            with bypass_cache(bool(request.get('no_cache'))):
+                init_workspace(job.workspace)
+                job.handler = w.run(url=request.get('url', ''), text=request.get('body', ''), file=request.get('file', ''),
+                                    workspace=job.workspace)
+                async for ev in job.handler.stream_events(expose_internal=True):
+                    event = progress_event(ev)
+                    if event is not None:
+                        await job.publish(event)
+                result = await job.handler
+            self.completed += 1
+            await job.finish('ok', result=str(result))
+        except Exception as e:
+            if job.handler is not None and job.handler.cancelled():
+                await job.finish('cancelled')
+            else:
+                self.failed += 1
+                await job.finish('error', error=f'{type(e).__name__}: {e}')
+        finally:
+            job.handler = None
+            if w.metrics is not None and os.path.isdir(job.workspace):
+                w.metrics.write(job.workspace)
+
+    async def handle(self, reader, writer):
+        """Answers one HTTP request of a connection.
+
+        Routes:
+            GET /health
+            GET /stats                 queue depth, concurrency and job counts
+            PUT /config                {"concurrency": n} changes the number of running jobs
+            POST /jobs                 queues a job, 429 when the queue is full
+            GET /jobs                  status of every known job
+            GET /jobs/<id>             status of a job
+            GET /jobs/<id>/events      progress events of a job as JSON lines until it is finished
+            DELETE /jobs/<id>          cancels a queued or running job
+        """
+        try:
+            try:
+                method, path, body = await read_request(reader)
+                parts = [part for part in path.split('?')[0].split('/') if part]
+                if parts[-1:] == ['events'] and len(parts) == 3 and method == 'GET':
+                    job = self._job(parts[1])
+                    write_head(writer, 200, 'application/x-ndjson')
+                    async for event in job.follow():
+                        writer.write(json.dumps(event).encode('utf-8') + b'\n')
+                        await writer.drain()
+                    return
+                status, response = await self._route(method, parts, body)
+            except HTTPError as e:
+                status, response = e.status, {'error': str(e)}
+            data = json.dumps(response).encode('utf-8')
+            write_head(writer, status, 'application/json', len(data))
+            writer.write(data)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _route(self, method:str, parts:list, body:bytes):
+        if parts == ['health']:
+            return 200, {'status': 'ok'}
+        if parts == ['stats'] and method == 'GET':
+            return 200, self.stats()
+        if parts == ['config'] and method == 'PUT':
+            concurrency = parse_json(body).get('concurrency')
+            if not isinstance(concurrency, int) or concurrency < 1:
+                raise HTTPError(400, 'concurrency must be a positive integer')
+            self.set_concurrency(concurrency)
+            return 200, self.stats()
+        if parts == ['jobs'] and method == 'POST':
+            job = self.submit(parse_json(body))
+            return 202, job.record()
+        if parts == ['jobs'] and method == 'GET':
+            return 200, [job.record() for job in self.jobs.values()]
+        if len(parts) == 2 and parts[0] == 'jobs' and method == 'GET':
+            return 200, self._job(parts[1]).record()
+        if len(parts) == 2 and parts[0] == 'jobs' and method == 'DELETE':
+            job = self._job(parts[1])
+            await self.cancel(job)
+            return 200, job.record()
+        if parts and parts[0] in ('health', 'stats', 'config', 'jobs'):
+            raise HTTPError(405, f'{method} is not supported on /{"/".join(parts)}')
+        raise HTTPError(404, 'Not found')
+
+    def _job(self, job_id:str):
+        if job_id not in self.jobs:
+            raise HTTPError(404, f'Unknown job {job_id}')
+        return self.jobs[job_id]
+
+async def read_request(reader):
+    """Reads an HTTP request.
+
+    Returns:
+        tuple of the method, the path and the body
+    """
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.LimitOverrunError:
+        raise HTTPError(413, 'Request headers are too large')
+    lines = head.decode('latin-1').split('\r\n')
+    try:
+        method, path, _ = lines[0].split(' ', 2)
+    except ValueError:
+        raise HTTPError(400, 'Malformed request line')
+    headers = dict(line.split(':', 1) for line in lines[1:] if ':' in line)
+    headers = {name.strip().lower(): value.strip() for name, value in headers.items()}
+    try:
+        length = int(headers.get('content-length', 0))
+    except ValueError:
+        raise HTTPError(400, 'Content-Length must be an integer')
+    if length < 0:
+        raise HTTPError(400, 'Content-Length must not be negative')
+    if length > MAX_REQUEST_BYTES:
+        raise HTTPError(413, f'Request body is larger than {MAX_REQUEST_BYTES} bytes')
+    return method.upper(), path, await reader.readexactly(length)
+
+def parse_json(body:bytes):
+    """Returns the JSON object of a request body."""
+    try:
+        data = json.loads(body or b'{}')
+    except ValueError:
+        raise HTTPError(400, 'Request body is not valid JSON')
+    if not isinstance(data, dict):
+        raise HTTPError(400, 'Request body must be a JSON object')
+    return data
+
+def write_head(writer, status:int, content_type:str, length:int = None):
+    """Writes status line and headers, a response without length ends when the connection is closed."""
+    lines = [f'HTTP/1.1 {status} {HTTP_REASONS.get(status, "")}', f'Content-Type: {content_type}', 'Connection: close']
+    if length is not None:
+        lines.append(f'Content-Length: {length}')
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+def warm_worker():
+    """Loads the video and pdf modules in a worker process of the pool."""
+    from image_gen import caption_style
+    from video_gen import ffmpeg_binary, moviepy_editor
+    moviepy_editor()
+    ffmpeg_binary()
+    caption_style()
+
+async def warm_up(executor, processes:int):
+    """Imports the modules the workflow steps load lazily and starts the worker processes.
+
+    Args:
+        executor: process pool of the server
+        processes: number of processes of the pool
+    """
+    for name in WARM_MODULES:
+        try:
+            import_module(name)
+        except ImportError:
+            pass
+    warm_worker()
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*(loop.run_in_executor(executor, warm_worker) for _ in range(processes)))
+
+async def start_server(server:StoryServer, host:str = SERVER_HOST, port:int = SERVER_PORT, socket_path:str = None):
+    """Starts listening for requests of a story server on a TCP port or a unix socket.
+
+    Returns:
+        the asyncio server
+    """
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        return await asyncio.start_unix_server(server.handle, path=socket_path)
+    return await asyncio.start_server(server.handle, host, port)
+
+async def serve(make_workflow, root:str, host:str = SERVER_HOST, port:int = SERVER_PORT, socket_path:str = None,
+                concurrency:int = 4, queue_size:int = QUEUE_SIZE, processes:int = None):
+    """Runs the story server until it is interrupted.
+
+    Args:
+        make_workflow: callable returning a configured workflow
+        root: workspace directory, each job gets a sub directory
+        host: address to listen on
+        port: TCP port to listen on
+        socket_path: unix socket to listen on instead of the TCP port
+        concurrency: number of jobs running at the same time
+        queue_size: maximum number of queued jobs
+        processes: size of the process pool, defaults to the number of cores
+    """
+    processes = processes or os.cpu_count() or 1
+    with ProcessPoolExecutor(processes) as executor:
+        await warm_up(executor, processes)
+        server = StoryServer(make_workflow, root, concurrency, queue_size, executor)
+        listener = await start_server(server, host, port, socket_path)
+        print(f"Serving story jobs on {socket_path or f'http://{host}:{port}'}")
+        async with listener:
+            await listener.serve_forever()
@@ -0,0 +1,101 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+from metrics import add
+
+_groups = {}
+_groups_lock = threading.Lock()
+
+class SingleFlight:
+    """Coalesces concurrent identical calls into one upstream call.
+
+    The first caller of a key runs the call while callers arriving before it
+    finishes wait for and share its result or exception. Nothing is kept
+    after the call finishes, caching is left to the caches. Calls can be
+    made from coroutines and from threads, and both share the same calls.
+
+    Args:
+        name: name of the group of calls in the statistics
+    """
+    def __init__(self, name:str):
+        self.name = name
+        self.calls = 0
+        self.saved = 0
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def _join(self, key:str):
+        """Returns the future of the call of a key and whether the caller has to run it."""
+        with self._lock:
+            self.calls += 1
+            future = self._flights.get(key)
+            if future is not None:
+                self.saved += 1
+                return future, False
+            future = self._flights[key] = Future()
+            return future, True
+
+    def _finish(self, key:str, future:Future, result = None, error:BaseException = None):
+        with self._lock:
+            del self._flights[key]
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def do(self, key:str, func, *args):
+        """Calls func(*args) unless the same call is in flight, then waits for its result.
+
+        Args:
+            key: key identifying identical calls
+            func: function making the upstream call
+            args: arguments of the function
+        Returns:
+            result of the shared call
+        """
+        future, leader = self._join(key)
+        if not leader:
+            add(coalesced_calls=1)
+            return future.result()
+        try:
+            result = func(*args)
+        except BaseException as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, result)
+        return result
+
+    async def ado(self, key:str, func, *args):
+        """Awaits func(*args) unless the same call is in flight, then waits for its result.
+
+        Args:
+            key: key identifying identical calls
+            func: coroutine function making the upstream call
+            args: arguments of the function
+        Returns:
+            result of the shared call
+        """
+        future, leader = self._join(key)
+        if not leader:
+            add(coalesced_calls=1)
+            return await asyncio.wrap_future(future)
+        try:
+            result = await func(*args)
+        except BaseException as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, result)
+        return result
+
+def single_flight(name:str):
+    """Returns the process-wide single flight group of a name."""
+    with _groups_lock:
+        if name not in _groups:
+            _groups[name] = SingleFlight(name)
+        return _groups[name]
+
+def single_flight_stats():
+    """Returns calls made and calls saved by coalescing for every group of the process."""
+    with _groups_lock:
+        return {name: {'calls': group.calls, 'saved': group.saved} for name, group in _groups.items()}
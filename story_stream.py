@@ -0,0 +1,135 @@
+import json
+import re
+from contextlib import aclosing
+
+from pydantic import ValidationError
+
+from models import ChildrenStory, StoryPage
+from prompts import STORY_JSON_PROMPT, STORY_JSON_CONTINUE_PROMPT
+
+MAX_REPAIRS = 2
+
+TITLE_PATTERN = re.compile(r'"title"\s*:\s*("(?:[^"\\]|\\.)*")')
+PAGES_PATTERN = re.compile(r'"pages"\s*:\s*\[')
+
+class StoryStreamParser:
+    """Parses ChildrenStory JSON incrementally from a token stream.
+
+    Text is fed as it arrives. Every page object of the `pages` list is
+    parsed as soon as its closing brace arrives, so pages are available long
+    before the whole response is. Parsing stops at the first page that is
+    not valid JSON or not a valid StoryPage, which marks the tail as broken.
+    """
+    def __init__(self):
+        self.buffer = ''
+        self.title = None
+        self.pages = []
+        self.done = False
+        self.broken = False
+        self._pos = None
+        self._start = None
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, text:str):
+        """Adds streamed text.
+
+        Args:
+            text: next piece of the response
+        Returns:
+            list of pages completed by the text
+        """
+        self.buffer += text
+        if self.title is None:
+            match = TITLE_PATTERN.search(self.buffer)
+            if match:
+                self.title = json.loads(match.group(1))
+        if self._pos is None:
+            match = PAGES_PATTERN.search(self.buffer)
+            if match is None:
+                return []
+            self._pos = match.end()
+        pages = []
+        while self._pos < len(self.buffer) and not (self.done or self.broken):
+            char = self.buffer[self._pos]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == '\\':
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == '{':
+                if self._depth == 0:
+                    self._start = self._pos
+                self._depth += 1
+            elif char == '}':
+                self._depth -= 1
+                if self._depth == 0:
+                    page = self._parse_page(self.buffer[self._start:self._pos + 1])
+                    if page is None:
+                        self.broken = True
+                    else:
+                        pages.append(page)
+            elif char == ']' and self._depth == 0:
+                self.done = True
+            self._pos += 1
+        self.pages.extend(pages)
+        return pages
+
+    @staticmethod
+    def _parse_page(text:str):
+        try:
+            return StoryPage.model_validate(json.loads(text))
+        except (ValueError, ValidationError):
+            return None
+
+async def stream_story(llm, story:str, max_repairs:int = MAX_REPAIRS):
+    """Generates a children's book from a story, yielding its parts as they are written.
+
+    When the response is cut short or a page is malformed, the pages that
+    were parsed are kept and only the remaining pages are asked for, up to
+    max_repairs times.
+
+    Args:
+        llm: LLM used for generation
+        story: story text
+        max_repairs: maximum number of continuation requests
+    Returns:
+        async generator of ('title', str) and ('page', StoryPage) tuples
+    """
+    from llama_index.core import PromptTemplate
+    from llama_index.core.output_parsers import PydanticOutputParser
+    output_parser = PydanticOutputParser(output_cls=ChildrenStory)
+    prompt = output_parser.format(PromptTemplate(STORY_JSON_PROMPT).format(story=story))
+    title = None
+    pages = []
+    for attempt in range(max_repairs + 1):
+        parser = StoryStreamParser()
+        async with aclosing(await llm.astream_complete(prompt)) as stream:
+            async for response in stream:
+                for page in parser.feed(response.delta or ''):
+                    if pages and page.page_no <= pages[-1].page_no:
+                        continue
+                    pages.append(page)
+                    yield 'page', page
+                if title is None and parser.title is not None:
+                    title = parser.title
+                    yield 'title', title
+                if parser.broken:
+                    break
+        if parser.done and title is not None:
+            return
+        if attempt == max_repairs:
+            break
+        prompt = PromptTemplate(STORY_JSON_CONTINUE_PROMPT).format(
+            story=story,
+            title=title or '',
+            pages=json.dumps([page.model_dump() for page in pages]),
+            next_page=pages[-1].page_no + 1 if pages else 1,
+        )
+    if title is None or not pages:
+        raise ValueError('Could not generate a valid children story')
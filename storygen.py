@@ -1,41 +1,44 @@
 import argparse
 import asyncio
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import aclosing
 import nest_asyncio
 from dotenv import load_dotenv
-from llama_index.core import Settings
-from llama_index.core import  SimpleDirectoryReader, ServiceContext, SummaryIndex
-from llama_index.llms.nvidia import NVIDIA
-from llama_index.embeddings.nvidia import NVIDIAEmbedding
 
-from llama_index.core.workflow.retry_policy import ConstantDelayRetryPolicy
+#workflow classes come from the standalone workflows package, llama_index itself is imported by the steps that need it
+from workflows.retry_policy import ConstantDelayRetryPolicy
     
-from llama_index.core.workflow import (
-    Event,
-    StartEvent,
-    StopEvent,
+from workflows import (
+    Context,
     Workflow,
     step,
 )
-from llama_index.utils.workflow import (
-    draw_all_possible_flows,
-    draw_most_recent_execution,
+from workflows.events import (
+    Event,
+    StartEvent,
+    StopEvent,
 )
 
-from llama_index.core import PromptTemplate
-from llama_index.core.program import LLMTextCompletionProgram
-from llama_index.core.response_synthesizers import SimpleSummarize
-
-from nemoguardrails import LLMRails, RailsConfig
-from llama_index.core.output_parsers import PydanticOutputParser
-
-from image_gen import (generate_image, base64_to_imagefile, create_pdf, pdf_to_image)
-from video_gen import (save_audio, save_audio_video, save_video)
-from utils import (write_file, read_file, has_file, save_url_data, read_story_json, has_prompts, parse_prompt, get_full_story_with_title)
+from batch import run_batch
+from server import (SERVER_HOST, SERVER_PORT, QUEUE_SIZE, serve)
+from cache import (DiskCache, bypass_cache)
+from summarize import map_reduce_summarize
+from summarize import CHUNK_SIZE as SUMMARY_CHUNK_SIZE, FAN_OUT as SUMMARY_FAN_OUT
+from story_stream import stream_story
+from image_prompts import (WINDOW_TOKENS, generate_prompts_batched)
+from guardrails import (CHUNK_SIZE, get_rails, make_story_safe)
+from image_gen import (ImageGenClient, NVIDIA_SD3_URL, PDF_PROFILES, save_imagefile, create_pdf, compose_frame, image_cache_key)
+from video_gen import (merge_audio_video, save_video, save_still_video)
+from tts import (TTS_BACKENDS, GTTSBackend, synthesize_to_file, page_text)
+from manifest import (load_manifest, input_hash)
+from metrics import (RunMetrics, measure, measure_step, acquire, file_size, call_started)
+from utils import (write_file, read_file, has_file, save_url_data, read_story_json, parse_prompt, get_full_story_with_title, init_workspace, iter_pdf_pages, iterate_in_thread)
 
-from events import (StoryEvent, ChildrenStoryEvent, PromptEvent, PDFEvent, RawStoryEvent, StorySummaryEvent, BookImageEvent, AudioEvent)
+from events import (StoryEvent, ChildrenStoryEvent, RawStoryEvent, StorySummaryEvent, PageEvent, PageNarrationEvent, PagePromptEvent, PageImageEvent, PageAudioEvent, PageReadyEvent, PageProgressEvent)
 from models import (ChildrenStory, ChildrenStoryPrompt)
-from prompts import STORY_JSON_PROMPT, STORY_GENERATE_IMAGE_PROMPT, SAFE_STORY_PROMPT, EXTRACT_SUMMARIZE_STORY_PROMPT, STORY_TITLE_GENERATE_IMAGE_PROMPT
+from prompts import STORY_JSON_PROMPT, STORY_GENERATE_IMAGE_PROMPT, EXTRACT_SUMMARIZE_STORY_PROMPT, STORY_TITLE_GENERATE_IMAGE_PROMPT
 
 
 MODEL_NAME = 'meta/llama3-70b-instruct'
@@ -50,61 +53,129 @@ STORY_PDF_FILE = 'story.pdf'
 TITLE_PROMPT_FILE = 'title_prompt.txt'
 TITLE_JPEG_FILE = 'title.jpg'
 VIDEO_NAME = 'story_video.mp4'
+CACHE_PATH = './.cache'
+LLM_CACHE_SIZE_MB = 256
+IMAGE_CACHE_SIZE_MB = 1024
+TTS_CACHE_SIZE_MB = 256
+URL_CACHE_SIZE_MB = 64
+MAX_CONCURRENCY = 8
+MAX_IMAGE_CONCURRENCY = 4
+PAGE_WORKERS = 32
+
+def configured_llm():
+    """Returns the LLM set in the llama_index Settings, importing llama_index on first use."""
+    from llama_index.core import Settings
+    return Settings.llm
 
 class ChildrenStoryGenerationWorkflow(Workflow):
     test_mode = False
     create_pdf = False
+    max_concurrency = MAX_CONCURRENCY
+    image_url = NVIDIA_SD3_URL
+    image_client = None
+    url_cache = None
+    executor = None
+    renderer = 'clips'
+    pdf_profile = 'original'
+    video_only = False
+    tts_backend = None
+    tts_cache = None
+    frame_size = None
+    guardrail_chunk_size = CHUNK_SIZE
+    summary_chunk_size = SUMMARY_CHUNK_SIZE
+    summary_fan_out = SUMMARY_FAN_OUT
+    batch_prompts = False
+    stream_json = False
+    prompt_window_tokens = WINDOW_TOKENS
+    metrics = None
+
+    async def run_cpu(self, func, *args, output:str = None):
+        """Runs a CPU bound function in the workflow executor without blocking the event loop.
+
+        The call is measured with the time it waited for a worker and the size of its output file.
+        """
+        with measure(func.__name__) as m:
+            submitted = time.time()
+            started, result = await asyncio.get_running_loop().run_in_executor(self.executor, call_started, func, *args)
+            m.wait += max(0.0, started - submitted)
+            if output:
+                m.add(bytes_written=file_size(output))
+            return result
+
     #workflow step to read story from a url and pass to next step
-    #can have shortcut to descendant step if results were previously persisted
+    #each run works in its own workspace directory which is passed along in the events
+    #a previously generated story.json is reused and the workspace manifest decides which artifacts are rebuilt
     @step
-    async def read_story(self, ev: StartEvent) -> ChildrenStoryEvent|PromptEvent|PDFEvent|RawStoryEvent|BookImageEvent|StopEvent:
-        #TO-DO: PDF support
-        if hasattr(ev, 'pdf'):
-            return StopEvent(result="PDF support is not available yet!")
-        if len(ev.url) > 0: 
-            save_url_data(ev.url, f'{DATA_PATH}/{RAW_STORY_FILE}')
-            return RawStoryEvent(path=f'{DATA_PATH}/{RAW_STORY_FILE}')
-        elif has_file(DATA_PATH, STORY_JSON_FILE) and has_file(DATA_PATH, STORY_PDF_FILE):
-            story = read_story_json(f'{DATA_PATH}/{STORY_JSON_FILE}')
-            return PDFEvent(story = story, path=f'{DATA_PATH}/{STORY_PDF_FILE}')
-        elif has_file(DATA_PATH, STORY_JSON_FILE):
-            story = read_story_json(f'{DATA_PATH}/{STORY_JSON_FILE}')
-            if has_file(f'{DATA_PATH}/{IMAGE_PATH}', TITLE_JPEG_FILE):
-                return BookImageEvent(story = story, path=f'{DATA_PATH}/{IMAGE_PATH}')
-            elif has_prompts(DATA_PATH, story):
-                return PromptEvent(path=DATA_PATH, story=story)
-            else:
-                return ChildrenStoryEvent(story=story)
-        elif has_file(DATA_PATH, RAW_STORY_FILE):
-           return RawStoryEvent(path=f'{DATA_PATH}/{RAW_STORY_FILE}')
+    @measure_step
+    async def read_story(self, ev: StartEvent) -> ChildrenStoryEvent|RawStoryEvent|StopEvent:
+        ws = init_workspace(ev.get('workspace', DATA_PATH), IMAGE_PATH, AUDIO_PATH, VIDEO_PATH)
+        url = ev.get('url', '')
+        text = ev.get('text', '')
+        file = ev.get('file', '')
+        if len(file) > 0:
+            if not os.path.isfile(file):
+                return StopEvent(result=f"{{error:'File not found: {file}'}}")
+            return RawStoryEvent(workspace=ws, path=file)
+        elif len(url) > 0: 
+            await asyncio.to_thread(save_url_data, url, f'{ws}/{RAW_STORY_FILE}', self.url_cache)
+            return RawStoryEvent(workspace=ws, path=f'{ws}/{RAW_STORY_FILE}')
+        elif len(text) > 0:
+            #the story.json of an earlier run is reused only when it was generated from the same text
+            manifest = load_manifest(ws)
+            inputs = input_hash(text)
+            if manifest.is_fresh(RAW_STORY_FILE, inputs) and has_file(ws, STORY_JSON_FILE):
+                return ChildrenStoryEvent(workspace=ws, story=read_story_json(f'{ws}/{STORY_JSON_FILE}'))
+            if has_file(ws, STORY_JSON_FILE):
+                os.remove(f'{ws}/{STORY_JSON_FILE}')
+            write_file(text, f'{ws}/{RAW_STORY_FILE}')
+            manifest.record(RAW_STORY_FILE, inputs)
+            return RawStoryEvent(workspace=ws, path=f'{ws}/{RAW_STORY_FILE}')
+        elif has_file(ws, STORY_JSON_FILE):
+            story = read_story_json(f'{ws}/{STORY_JSON_FILE}')
+            return ChildrenStoryEvent(workspace=ws, story=story)
+        elif has_file(ws, RAW_STORY_FILE):
+           return RawStoryEvent(workspace=ws, path=f'{ws}/{RAW_STORY_FILE}')
         else :
             return StopEvent(result="{error:'Please specify url'}")
 
     #workflow step to summarize story 
+    #large documents are summarized in concurrent chunks that are combined hierarchically
+    #pdf pages are extracted lazily and summarized while the rest of the document is read
     @step
+    @measure_step
     async def summarize_story(self, ev: RawStoryEvent) -> StorySummaryEvent:
-        reader = SimpleDirectoryReader(input_files=[ev.path])
-        docs = reader.load_data()
-        texts = [d.text for d in docs]
-        summarizer = SimpleSummarize(llm = Settings.llm)
-        response = await summarizer.aget_response(EXTRACT_SUMMARIZE_STORY_PROMPT, texts)
-        return StorySummaryEvent(story=str(response))
+        if ev.path.lower().endswith('.pdf'):
+            texts = iterate_in_thread(iter_pdf_pages(ev.path, executor=self.executor))
+        else:
+            from llama_index.core import SimpleDirectoryReader
+            reader = SimpleDirectoryReader(input_files=[ev.path])
+            docs = reader.load_data()
+            texts = [d.text for d in docs]
+        response = await map_reduce_summarize(texts, configured_llm(), EXTRACT_SUMMARIZE_STORY_PROMPT, self.summary_chunk_size,
+                                              self.summary_fan_out, self.max_concurrency)
+        return StorySummaryEvent(workspace=ev.workspace, story=response)
     
-    #workflow step to create guardrail to ensure story generated is safe     
+    #workflow step to create guardrail to ensure story generated is safe
+    #the rails engine is shared by all runs and long stories are checked in concurrent chunks
     @step 
+    @measure_step
     async def create_guardrail(self, ev: StorySummaryEvent) -> StoryEvent|StopEvent:
-        config = RailsConfig.from_path('config')
-        rails = LLMRails(config)
-        template = PromptTemplate(SAFE_STORY_PROMPT)
-        prompt = template.format(story=ev.story)
-        res = await rails.generate_async(prompt=prompt)
-        return StoryEvent(story=str(res))
+        res, refused = await make_story_safe(ev.story, self.guardrail_chunk_size, self.max_concurrency)
+        if refused:
+            return StopEvent(result=res)
+        return StoryEvent(workspace=ev.workspace, story=res)
 
     #workflow step to generate book title and pages in json structure   
+    #in streaming mode pages are parsed as they are written and their narration starts right away
     @step #(retry_policy=ConstantDelayRetryPolicy(delay=5, maximum_attempts=5))
-    async def generate_json(self, ev: StoryEvent) -> ChildrenStoryEvent:
+    @measure_step
+    async def generate_json(self, ctx: Context, ev: StoryEvent) -> ChildrenStoryEvent:
         story = ev.story
+        if self.stream_json:
+            return await self.stream_json_pages(ctx, ev)
         #print(story)
+        from llama_index.core.output_parsers import PydanticOutputParser
+        from llama_index.core.program import LLMTextCompletionProgram
         program = LLMTextCompletionProgram.from_defaults(
             output_parser=PydanticOutputParser(output_cls=ChildrenStory),
             prompt_template_str=STORY_JSON_PROMPT,
@@ -113,68 +184,239 @@ class ChildrenStoryGenerationWorkflow(Workflow):
         output:ChildrenStory = program(story=story)
         if self.test_mode:
             output.pages = output.pages[0:2]
-        write_file(output.json(), f'{DATA_PATH}/{STORY_JSON_FILE}')
-        return ChildrenStoryEvent(story=output)
+        write_file(output.json(), f'{ev.workspace}/{STORY_JSON_FILE}')
+        return ChildrenStoryEvent(workspace=ev.workspace, story=output)
+
+    async def stream_json_pages(self, ctx, ev):
+        """Generates the book with a streamed completion, sending page narration events as pages complete."""
+        await self.init_page_resources(ctx)
+        output = ChildrenStory(title='', pages=[])
+        max_pages = 2 if self.test_mode else None
+        async with aclosing(stream_story(configured_llm(), ev.story)) as parts:
+            async for kind, value in parts:
+                if kind == 'title':
+                    output.title = value
+                    number = 0
+                elif max_pages is None or len(output.pages) < max_pages:
+                    output.pages.append(value)
+                    number = len(output.pages)
+                else:
+                    continue
+                if not self.create_pdf:
+                    partial = ChildrenStory(title=output.title, pages=list(output.pages))
+                    ctx.send_event(PageNarrationEvent(workspace=ev.workspace, story=partial, number=number))
+                if max_pages is not None and output.title and len(output.pages) == max_pages:
+                    break
+        write_file(output.json(), f'{ev.workspace}/{STORY_JSON_FILE}')
+        return ChildrenStoryEvent(workspace=ev.workspace, story=output, narrated=not self.create_pdf)
+
+    async def init_page_resources(self, ctx):
+        """Sets up the state and clients shared by the page steps of a run, once."""
+        if await ctx.store.get('page_inputs', default=None) is not None:
+            return
+        await ctx.store.set('page_inputs', {})
+        await ctx.store.set('llm_limit', asyncio.Semaphore(self.max_concurrency))
+        await ctx.store.set('tts_limit', asyncio.Semaphore(self.max_concurrency))
+        await ctx.store.set('encode_limit', asyncio.Semaphore(os.cpu_count() or 1))
+        #the image client is owned by whoever runs the workflow, which closes it however the run ends
+        if self.image_client is None:
+            raise ValueError('image_client must be set before the workflow runs')
+
+    #workflow step to fan out the book into pages, number 0 being the title page
+    #each page flows through the prompt and image steps while its narration is synthesized alongside
+    #narration of a streamed book was already started by generate_json
+    #in batched mode the stale page prompts are generated a window of pages per call before the pages fan out
+    @step
+    @measure_step
+    async def split_pages(self, ctx: Context, ev: ChildrenStoryEvent) -> PageEvent|PageNarrationEvent:
+        await self.init_page_resources(ctx)
+        numbers = range(len(ev.story.pages) + 1)
+        if not self.create_pdf and not ev.narrated:
+            for number in numbers:
+                ctx.send_event(PageNarrationEvent(workspace=ev.workspace, story=ev.story, number=number))
+        if self.batch_prompts:
+            await self.batch_generate_prompts(ev.workspace, ev.story)
+        for number in numbers:
+            ctx.send_event(PageEvent(workspace=ev.workspace, story=ev.story, number=number))
+
+    async def batch_generate_prompts(self, ws, story):
+        """Generates the stale image prompts of a book with batched calls.
+
+        Prompts are recorded like the ones of generate_prompt, which then only
+        generates the prompts of pages the batched calls failed for.
+        """
+        manifest = load_manifest(ws)
+        names = self.prompt_files(story)
+        stale = [number for number in range(len(story.pages) + 1) if not manifest.is_fresh(names[number], self.prompt_inputs(story, number))]
+        if not stale:
+            return
+        prompts = await generate_prompts_batched(story, stale, configured_llm(), self.prompt_window_tokens, max_concurrency=self.max_concurrency)
+        for number, prompt in prompts.items():
+            write_file(f'"{prompt}"', f'{ws}/{names[number]}')
+            manifest.record(names[number], self.prompt_inputs(story, number))
+
+    @staticmethod
+    def prompt_inputs(story, number):
+        """Returns hash of the inputs of the image prompt of a page, 0 being the title page."""
+        if number == 0:
+            return input_hash(STORY_TITLE_GENERATE_IMAGE_PROMPT, story.title)
+        page = story.pages[number - 1]
+        return input_hash(STORY_GENERATE_IMAGE_PROMPT, story.title, page.page_no, page.content)
 
     #workflow step to generate image prompt for book page
-    @step #(retry_policy=ConstantDelayRetryPolicy(delay=5, maximum_attempts=20))
-    async def generate_prompt(self, ev: ChildrenStoryEvent) -> PromptEvent|StopEvent:
+    #a page prompt is only regenerated when the title or the page text changed
+    @step(num_workers=PAGE_WORKERS) #(retry_policy=ConstantDelayRetryPolicy(delay=5, maximum_attempts=20))
+    @measure_step
+    async def generate_prompt(self, ctx: Context, ev: PageEvent) -> PagePromptEvent:
         story = ev.story
-        template = PromptTemplate(STORY_TITLE_GENERATE_IMAGE_PROMPT)
-        prompt = template.format(story=get_full_story_with_title(story))
-
-        response = Settings.llm.complete(prompt)
-        write_file(response.text, f'{DATA_PATH}/{TITLE_PROMPT_FILE}')
-        for page in story.pages:
-            template = PromptTemplate(STORY_GENERATE_IMAGE_PROMPT)
-            prompt = template.format(page = f"page_no {str(page.page_no)}", story=get_full_story_with_title(story))
-
-            response = Settings.llm.complete(prompt)
-            write_file(response.text, f'{DATA_PATH}/{str(page.page_no)}_prompt.txt')
-        return PromptEvent(path=DATA_PATH, story=story)
+        manifest = load_manifest(ev.workspace)
+        name = self.prompt_files(story)[ev.number]
+        inputs = self.prompt_inputs(story, ev.number)
+        if not manifest.is_fresh(name, inputs):
+            from llama_index.core import PromptTemplate
+            full_story = get_full_story_with_title(story)
+            if ev.number == 0:
+                prompt = PromptTemplate(STORY_TITLE_GENERATE_IMAGE_PROMPT).format(story=full_story)
+            else:
+                page = story.pages[ev.number - 1]
+                prompt = PromptTemplate(STORY_GENERATE_IMAGE_PROMPT).format(page = f"page_no {str(page.page_no)}", story=full_story)
+            async with acquire(await ctx.store.get('llm_limit')):
+                response = await configured_llm().acomplete(prompt)
+            write_file(response.text, f'{ev.workspace}/{name}')
+            manifest.record(name, inputs)
+        return PagePromptEvent(workspace=ev.workspace, story=story, number=ev.number)
         
-    #workflow step to generate image using prompt generated in previous step    
-    @step
-    async def generate_image(self, ev: PromptEvent) -> BookImageEvent:
-        path = ev.path
+    #workflow step to generate image using prompt generated in previous step
+    #requests of all pages share one pooled client that bounds concurrency
+    @step(num_workers=PAGE_WORKERS)
+    @measure_step
+    async def generate_image(self, ctx: Context, ev: PagePromptEvent) -> PageImageEvent:
+        manifest = load_manifest(ev.workspace)
+        prompt = parse_prompt(f'{ev.workspace}/{self.prompt_files(ev.story)[ev.number]}')
+        name = f'{IMAGE_PATH}/{self.image_files(ev.story)[ev.number]}'
+        inputs = input_hash(image_cache_key(prompt, self.image_url))
+        if not manifest.is_fresh(name, inputs):
+            save_imagefile(await self.image_client.generate_bytes(prompt), f'{ev.workspace}/{name}')
+            manifest.record(name, inputs)
+        return PageImageEvent(workspace=ev.workspace, story=ev.story, number=ev.number)
+
+    #workflow step to generate audio file using tts conversion, only when the page text changed
+    #runs in parallel with prompt and image generation since it only needs the page text
+    @step(num_workers=PAGE_WORKERS)
+    @measure_step
+    async def generate_audio(self, ctx: Context, ev: PageNarrationEvent) -> PageAudioEvent:
         story = ev.story
-        prompt = parse_prompt(f'{DATA_PATH}/{TITLE_PROMPT_FILE}')
-        out_file = f'{path}/{IMAGE_PATH}/title.jpg'
-        key = os.environ["NVIDIA_API_KEY"]
-        base64_to_imagefile(generate_image(prompt, key), out_file)
-        
-        for i in range(len(story.pages)):
-            prompt = parse_prompt(f'{path}/{i+1}_prompt.txt')
-            print(prompt)
-            out_file = f'{path}/{IMAGE_PATH}/{i+1}.jpg'
-            base64_to_imagefile(generate_image(prompt, key), out_file)
-        return BookImageEvent(story = story, path=f'{path}/{IMAGE_PATH}')
-
-    #workflow step to generate pdf by merging page contents and images generated in previous steps
-    @step
-    async def generate_pdf(self, ev: BookImageEvent) -> PDFEvent|StopEvent:
-        create_pdf(f'{DATA_PATH}/{STORY_PDF_FILE}', ev.story, ev.path)
+        manifest = load_manifest(ev.workspace)
+        backend = self.tts_backend or GTTSBackend()
+        text = story.title if ev.number == 0 else page_text(story.pages[ev.number - 1])
+        name = f'{AUDIO_PATH}/{self.audio_files(story)[ev.number]}'
+        inputs = input_hash(backend.name, backend.voice, backend.lang, text)
+        if not manifest.is_fresh(name, inputs):
+            async with acquire(await ctx.store.get('tts_limit')):
+                await asyncio.to_thread(synthesize_to_file, backend, text, f'{ev.workspace}/{name}', self.tts_cache)
+            manifest.record(name, inputs)
+        return PageAudioEvent(workspace=ev.workspace, story=story, number=ev.number)
+
+    #workflow step to compose the video frame of a page and encode its clip
+    #joins the image and audio branches of a page, pages are done once their image is ready when only the pdf is generated
+    #frames and clips are rebuilt only when the page image, text or audio changed
+    @step(num_workers=PAGE_WORKERS)
+    @measure_step
+    async def generate_clip(self, ctx: Context, ev: PageImageEvent|PageAudioEvent) -> PageReadyEvent:
         if self.create_pdf:
-            return StopEvent(result=f'{DATA_PATH}/{STORY_PDF_FILE}')
-        else:
-            return PDFEvent(story = ev.story, path=f'{DATA_PATH}/{STORY_PDF_FILE}')
-    
-    #workflow step to generate audio file using tts conversion
+            return self.page_ready(ctx, ev.workspace, ev.story, ev.number)
+        page_inputs = (await ctx.store.get('page_inputs')).setdefault(ev.number, {})
+        page_inputs[type(ev).__name__] = ev
+        if len(page_inputs) < 2:
+            return None
+        ws = ev.workspace
+        #narration of a streamed book may carry the book as it was when the page was written
+        story = page_inputs[PageImageEvent.__name__].story
+        manifest = load_manifest(ws)
+        text = None if ev.number == 0 else story.pages[ev.number - 1].content
+        is_right = ev.number % 2 == 0
+        image_name = f'{IMAGE_PATH}/{self.image_files(story)[ev.number]}'
+        audio_name = f'{AUDIO_PATH}/{self.audio_files(story)[ev.number]}'
+        frame_name = f'{IMAGE_PATH}/{ev.number}.png'
+        clip_name = f'{VIDEO_PATH}/{ev.number}.mp4'
+        frame_inputs = input_hash(self.frame_size, manifest.get(image_name), text, is_right)
+        clip_inputs = input_hash(frame_inputs, manifest.get(audio_name))
+        async with acquire(await ctx.store.get('encode_limit')):
+            if not manifest.is_fresh(frame_name, frame_inputs):
+                await self.run_cpu(compose_frame, f'{ws}/{image_name}', f'{ws}/{frame_name}', text, is_right, self.frame_size, output=f'{ws}/{frame_name}')
+                manifest.record(frame_name, frame_inputs)
+            if self.renderer == 'clips' and not manifest.is_fresh(clip_name, clip_inputs):
+                await self.run_cpu(merge_audio_video, f'{ws}/{frame_name}', f'{ws}/{audio_name}', f'{ws}/{clip_name}', output=f'{ws}/{clip_name}')
+                manifest.record(clip_name, clip_inputs)
+        return self.page_ready(ctx, ws, story, ev.number)
+
+    @staticmethod
+    def page_ready(ctx, ws, story, number):
+        """Reports a finished page on the event stream of the run and returns its PageReadyEvent."""
+        ctx.write_event_to_stream(PageProgressEvent(workspace=ws, number=number, total=len(story.pages) + 1))
+        return PageReadyEvent(workspace=ws, story=story, number=number)
+
+    #workflow step to assemble the pdf and the final video once every page is ready
+    #the pdf is skipped in video only mode
     @step
-    async def generate_audio(self, ev: PDFEvent) -> AudioEvent:
+    @measure_step
+    async def generate_video(self, ctx: Context, ev: PageReadyEvent) -> StopEvent:
         story = ev.story
-        save_audio(story, f'{DATA_PATH}/{AUDIO_PATH}' )
-        return AudioEvent(story=story, pdf=ev.path, path=f'{DATA_PATH}/{AUDIO_PATH}' )
+        if ctx.collect_events(ev, [PageReadyEvent] * (len(story.pages) + 1)) is None:
+            return None
+        ws = ev.workspace
+        manifest = load_manifest(ws)
+        pdf_file = f'{ws}/{STORY_PDF_FILE}'
+        if self.create_pdf or not self.video_only:
+            inputs = input_hash(self.pdf_profile, story.title, [page.content for page in story.pages],
+                                [manifest.get(f'{IMAGE_PATH}/{name}') for name in self.image_files(story)])
+            if not manifest.is_fresh(STORY_PDF_FILE, inputs):
+                await self.run_cpu(create_pdf, pdf_file, story, f'{ws}/{IMAGE_PATH}', self.pdf_profile, output=pdf_file)
+                manifest.record(STORY_PDF_FILE, inputs)
+        if self.create_pdf:
+            return StopEvent(result=pdf_file)
 
-    #workflow step to generate final video by merging audio and image files generated in previous steps
-    @step
-    async def generate_video(self, ev: AudioEvent) -> StopEvent:
-        pdf_to_image(ev.pdf, f'{DATA_PATH}/{IMAGE_PATH}' )
-        save_audio_video(ev.story, f'{DATA_PATH}/{IMAGE_PATH}' , ev.path, f'{DATA_PATH}/{VIDEO_PATH}' )
-        save_video(len(ev.story.pages) + 1, f'{DATA_PATH}/{VIDEO_PATH}' , f'{DATA_PATH}/{VIDEO_PATH}/{VIDEO_NAME}')
-        return StopEvent(result = f'{DATA_PATH}/{VIDEO_PATH}/{VIDEO_NAME}')
+        frame_inputs = [manifest.get(f'{IMAGE_PATH}/{number}.png') for number in range(len(story.pages) + 1)]
+        audio_inputs = [manifest.get(f'{AUDIO_PATH}/{name}') for name in self.audio_files(story)]
+        video_inputs = input_hash(self.renderer, frame_inputs, audio_inputs)
+        video_name = f'{VIDEO_PATH}/{VIDEO_NAME}'
+        if not manifest.is_fresh(video_name, video_inputs):
+            if self.renderer == 'still':
+                await self.run_cpu(save_still_video, story, f'{ws}/{IMAGE_PATH}', f'{ws}/{AUDIO_PATH}', f'{ws}/{video_name}', output=f'{ws}/{video_name}')
+            else:
+                await self.run_cpu(save_video, len(story.pages) + 1, f'{ws}/{VIDEO_PATH}', f'{ws}/{video_name}', output=f'{ws}/{video_name}')
+            manifest.record(video_name, video_inputs)
+        return StopEvent(result = f'{ws}/{video_name}')
+
+    @staticmethod
+    def prompt_files(story):
+        """Returns image prompt file names for the title and every page."""
+        return [TITLE_PROMPT_FILE] + [f'{page.page_no}_prompt.txt' for page in story.pages]
 
+    @staticmethod
+    def image_files(story):
+        """Returns generated image file names for the title and every page."""
+        return [TITLE_JPEG_FILE] + [f'{page.page_no}.jpg' for page in story.pages]
 
+    @staticmethod
+    def audio_files(story):
+        """Returns narration file names for the title and every page."""
+        return ['title.mp3'] + [f'{page.page_no}.mp3' for page in story.pages]
+
+
+async def run_single(w, processes:int = None, **kwargs):
+    """Runs one story with the CPU bound steps in a process pool of the run.
+
+    Args:
+        w: configured workflow
+        processes: size of the process pool, defaults to the number of cores
+        kwargs: start event fields of the run
+    Returns:
+        result of the workflow
+    """
+    with ProcessPoolExecutor(processes) as executor:
+        w.executor = executor
+        return await w.run(**kwargs)
 
 async def main():
     parser = argparse.ArgumentParser(description='This program generates story book')
@@ -183,10 +425,41 @@ async def main():
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument('-f', '--file', help='Path to the file')
     group.add_argument('-u', '--url', help='URL to the story')
+    group.add_argument('-b', '--batch', help='JSONL file with one story job per line')
+    group.add_argument('-s', '--serve', help='Run as a server taking story jobs over HTTP', action='store_true')
     parser.add_argument('-v', '--verbose', help='Increase output verbosity', action='store_true')
     parser.add_argument('-t', '--test', help='Run in test mode', action='store_true')
     parser.add_argument('-d', '--draw', help='Run in draw mode', action='store_true')
     parser.add_argument('-p', '--pdf', help='Output mode', action='store_true')
+    parser.add_argument('--pdf-profile', help='PDF image profile, smaller profiles downsample and recompress the page images', choices=list(PDF_PROFILES), default='original')
+    parser.add_argument('-r', '--renderer', help='Video renderer: per page clips or single pass still image encode', choices=['clips', 'still'], default='clips')
+    parser.add_argument('--video-only', help='Compose video frames directly and skip the PDF', action='store_true')
+    parser.add_argument('--frame-size', help='Video frame size as WIDTHxHEIGHT, defaults to the image size')
+    parser.add_argument('-w', '--workspace', help='Directory for the files generated by this run', default=DATA_PATH)
+    parser.add_argument('-c', '--concurrency', help='Maximum number of in-flight model requests', type=int, default=MAX_CONCURRENCY)
+    parser.add_argument('--image-concurrency', help='Maximum number of in-flight image requests', type=int, default=MAX_IMAGE_CONCURRENCY)
+    parser.add_argument('--image-url', help='Image generation endpoint', default=NVIDIA_SD3_URL)
+    parser.add_argument('--cache-dir', help='Directory of the persistent caches', default=CACHE_PATH)
+    parser.add_argument('--llm-cache-size', help='Size limit of the LLM completion cache in MB', type=int, default=LLM_CACHE_SIZE_MB)
+    parser.add_argument('--image-cache-size', help='Size limit of the image cache in MB', type=int, default=IMAGE_CACHE_SIZE_MB)
+    parser.add_argument('--url-cache-size', help='Size limit of the downloaded story cache in MB', type=int, default=URL_CACHE_SIZE_MB)
+    parser.add_argument('--tts-cache-size', help='Size limit of the narration cache in MB', type=int, default=TTS_CACHE_SIZE_MB)
+    parser.add_argument('--tts', help='Text to speech engine', choices=list(TTS_BACKENDS), default='gtts')
+    parser.add_argument('--voice', help='Text to speech voice, engine specific', default='')
+    parser.add_argument('--summary-chunk-size', help='Maximum size in tokens of a source chunk summarized by one call', type=int, default=SUMMARY_CHUNK_SIZE)
+    parser.add_argument('--summary-fan-out', help='Number of chunk summaries combined by one call', type=int, default=SUMMARY_FAN_OUT)
+    parser.add_argument('--stream-json', help='Stream the book generation and start narrating pages as they are written', action='store_true')
+    parser.add_argument('--batch-prompts', help='Generate image prompts of many pages with one call', action='store_true')
+    parser.add_argument('--prompt-window-tokens', help='Maximum page text tokens sent in one batched prompt call', type=int, default=WINDOW_TOKENS)
+    parser.add_argument('--guardrail-chunk-size', help='Maximum story length in characters checked by one guardrail call', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--jobs', help='Number of stories generated at the same time in batch and server mode', type=int, default=4)
+    parser.add_argument('--processes', help='Size of the process pool for PDF and video encoding', type=int)
+    parser.add_argument('--batch-output', help='JSONL file receiving batch results', default='batch_results.jsonl')
+    parser.add_argument('--no-cache', help='Ignore cached results for this run', action='store_true')
+    parser.add_argument('--host', help='Address the server listens on', default=SERVER_HOST)
+    parser.add_argument('--port', help='Port the server listens on', type=int, default=SERVER_PORT)
+    parser.add_argument('--socket', help='Unix socket the server listens on instead of the port')
+    parser.add_argument('--queue-size', help='Maximum number of jobs waiting in server mode, more are refused', type=int, default=QUEUE_SIZE)
     args = parser.parse_args()
     verbose = args.verbose
     test_mode = args.test
@@ -194,33 +467,81 @@ async def main():
     
     # Draw flow
     if args.draw:
+        from llama_index.utils.workflow import draw_all_possible_flows
         draw_all_possible_flows(ChildrenStoryGenerationWorkflow, filename="story_gen_workflow.html")
         return
     
     # Load environment variables from .env file
     load_dotenv()
-    Settings.llm = NVIDIA(model=MODEL_NAME)
+    from langchain_core.globals import set_llm_cache
+    from llama_index.core import Settings
+    from llama_index.embeddings.nvidia import NVIDIAEmbedding
+    from llm_cache import (CachedNVIDIA, GuardrailsLLMCache)
+    llm_cache = DiskCache(f'{args.cache_dir}/llm', args.llm_cache_size * 1024 * 1024)
+    Settings.llm = CachedNVIDIA(model=MODEL_NAME, cache=llm_cache)
+    set_llm_cache(GuardrailsLLMCache(llm_cache))
     Settings.embed_model = NVIDIAEmbedding(model=EMBED_MODEL_NAME, truncate="END")
+    # Build the guardrails engine once for all runs
+    get_rails()
     
     nest_asyncio.apply()
     
-    w = ChildrenStoryGenerationWorkflow(timeout=600, verbose=args.verbose)
-    w.test_mode = test_mode
-    w.create_pdf = create_pdf
-    if args.file:
-        if not args.file.endswith('.pdf'):
-            print("Error: file must be pdf.")
-            return 
-        else:    
-            result = await w.run(file = args.file)
-            print("############################################################\n")
-            print(result)
-            print("\n############################################################")
-    elif args.url:
-        result = await w.run(url = args.url)
-        print("############################################################\n")
-        print(result)
-        print("\n############################################################")
+    image_cache = DiskCache(f'{args.cache_dir}/image', args.image_cache_size * 1024 * 1024)
+    tts_cache = DiskCache(f'{args.cache_dir}/tts', args.tts_cache_size * 1024 * 1024)
+    url_cache = DiskCache(f'{args.cache_dir}/url', args.url_cache_size * 1024 * 1024)
+    tts_backend = TTS_BACKENDS[args.tts](voice=args.voice)
+    #one image client serves every run of the process so its connections are reused, it is closed when main ends
+    image_client = ImageGenClient(os.environ.get("NVIDIA_API_KEY", ""), invoke_url=args.image_url, max_concurrency=args.image_concurrency,
+                                  cache=image_cache)
+    def make_workflow():
+        w = ChildrenStoryGenerationWorkflow(timeout=600, verbose=args.verbose)
+        w.test_mode = test_mode
+        w.create_pdf = create_pdf
+        w.max_concurrency = args.concurrency
+        w.image_url = args.image_url
+        w.image_client = image_client
+        w.url_cache = url_cache
+        w.renderer = args.renderer
+        w.pdf_profile = args.pdf_profile
+        w.video_only = args.video_only
+        w.tts_backend = tts_backend
+        w.tts_cache = tts_cache
+        w.guardrail_chunk_size = args.guardrail_chunk_size
+        w.summary_chunk_size = args.summary_chunk_size
+        w.summary_fan_out = args.summary_fan_out
+        w.stream_json = args.stream_json
+        w.batch_prompts = args.batch_prompts
+        w.prompt_window_tokens = args.prompt_window_tokens
+        w.metrics = RunMetrics()
+        w.frame_size = tuple(int(v) for v in args.frame_size.split('x')) if args.frame_size else None
+        return w
+
+    w = make_workflow()
+    try:
+        with bypass_cache(args.no_cache):
+            if args.file:
+                if not args.file.endswith('.pdf'):
+                    print("Error: file must be pdf.")
+                    return 
+                else:    
+                    result = await run_single(w, args.processes, file = args.file, workspace = args.workspace)
+                    print("############################################################\n")
+                    print(result)
+                    print("\n############################################################")
+            elif args.batch:
+                await run_batch(args.batch, args.batch_output, make_workflow, args.workspace, args.jobs, args.processes)
+            elif args.serve:
+                await serve(make_workflow, args.workspace, args.host, args.port, args.socket, args.jobs, args.queue_size, args.processes)
+            elif args.url:
+                result = await run_single(w, args.processes, url = args.url, workspace = args.workspace)
+                print("############################################################\n")
+                print(result)
+                print("\n############################################################")
+            if not (args.batch or args.serve) and os.path.isdir(args.workspace):
+                for report_file in w.metrics.write(args.workspace):
+                    print(f"Metrics report: {report_file}")
+    finally:
+        await image_client.aclose()
 
 if __name__ == '__main__':
     asyncio.run(main())
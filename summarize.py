@@ -0,0 +1,94 @@
+import asyncio
+
+from prompts import (EXTRACT_SUMMARIZE_STORY_PROMPT, SUMMARIZE_CHUNK_PROMPT, COMBINE_SUMMARIES_PROMPT)
+from utils import gather_with_concurrency
+
+CHUNK_SIZE = 2048
+CHUNK_OVERLAP = 64
+FAN_OUT = 8
+
+async def iter_chunks(texts, splitter):
+    """Yields chunks of consecutive texts as soon as they are complete.
+
+    Short texts such as pdf pages are joined into full size chunks. Only the
+    unfinished tail is kept between texts, so the texts are never held in
+    memory all at once.
+
+    Args:
+        texts: iterable or async iterable of strings
+        splitter: SentenceSplitter defining the chunk size
+    Returns:
+        async generator of chunks
+    """
+    pending = ''
+    async for text in _aiter(texts):
+        pending = f'{pending}\n\n{text}' if pending else text
+        chunks = splitter.split_text(pending)
+        for chunk in chunks[:-1]:
+            yield chunk
+        pending = chunks[-1] if chunks else ''
+    if pending:
+        for chunk in splitter.split_text(pending):
+            yield chunk
+
+async def _aiter(texts):
+    if hasattr(texts, '__aiter__'):
+        async for text in texts:
+            yield text
+    else:
+        for text in texts:
+            yield text
+
+async def map_reduce_summarize(texts, llm, query:str = EXTRACT_SUMMARIZE_STORY_PROMPT, chunk_size:int = CHUNK_SIZE,
+                               fan_out:int = FAN_OUT, max_concurrency:int = 8):
+    """Summarizes documents of any length with hierarchical map-reduce.
+
+    Texts are split into chunks of at most chunk_size tokens, each chunk is
+    summarized concurrently, and the summaries are combined fan_out at a time
+    until a single summary remains. Chunks are summarized while the texts are
+    still being read, and reading pauses while max_concurrency chunks are in
+    flight.
+
+    Args:
+        texts: document texts, any iterable or async iterable of strings
+        llm: LLM used for summarization
+        query: instruction describing what to extract
+        chunk_size: maximum chunk size in tokens
+        fan_out: number of summaries combined by one call
+        max_concurrency: maximum number of in-flight LLM calls
+    Returns:
+        summary text
+    """
+    from llama_index.core import PromptTemplate
+    from llama_index.core.node_parser import SentenceSplitter
+    splitter = SentenceSplitter(chunk_size=chunk_size, chunk_overlap=CHUNK_OVERLAP)
+    map_template = PromptTemplate(SUMMARIZE_CHUNK_PROMPT)
+    reduce_template = PromptTemplate(COMBINE_SUMMARIES_PROMPT)
+
+    async def complete(prompt):
+        response = await llm.acomplete(prompt)
+        return response.text.strip()
+
+    limit = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def summarize_chunk(chunk):
+        try:
+            return await complete(map_template.format(query=query, text=chunk))
+        finally:
+            limit.release()
+
+    tasks = []
+    try:
+        async for chunk in iter_chunks(texts, splitter):
+            await limit.acquire()
+            tasks.append(asyncio.create_task(summarize_chunk(chunk)))
+        summaries = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    summaries = [summary for summary in summaries if summary]
+    while len(summaries) > 1:
+        groups = [summaries[i:i + max(2, fan_out)] for i in range(0, len(summaries), max(2, fan_out))]
+        summaries = await gather_with_concurrency(max_concurrency, *(complete(reduce_template.format(query=query, text='\n\n'.join(group))) for group in groups))
+    return summaries[0] if summaries else ''
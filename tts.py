@@ -0,0 +1,78 @@
+import io
+import subprocess
+
+from cache import cache_key
+from metrics import (measure, add)
+from video_gen import ffmpeg_binary
+
+class TTSBackend:
+    """Base class for text to speech engines.
+
+    Backends turn text into MP3 bytes. Subclass it to plug in another engine
+    or a test stub.
+
+    Args:
+        lang: language of the narration
+        voice: engine specific voice, empty for the default voice
+    """
+    name = 'base'
+
+    def __init__(self, lang:str = 'en', voice:str = ''):
+        self.lang = lang
+        self.voice = voice
+
+    def synthesize(self, text:str) -> bytes:
+        """Returns MP3 audio for the text."""
+        raise NotImplementedError
+
+class GTTSBackend(TTSBackend):
+    """Google Translate text to speech, the voice selects the accent top level domain."""
+    name = 'gtts'
+
+    def synthesize(self, text:str) -> bytes:
+        from gtts import gTTS
+        fp = io.BytesIO()
+        gTTS(text, lang=self.lang, tld=self.voice or 'com').write_to_fp(fp)
+        add(bytes_downloaded=fp.tell())
+        return fp.getvalue()
+
+class EspeakBackend(TTSBackend):
+    """Offline text to speech using espeak-ng, encoded to MP3 with ffmpeg."""
+    name = 'espeak'
+
+    def synthesize(self, text:str) -> bytes:
+        wav = subprocess.run(['espeak-ng', '--stdout', '-v', self.voice or self.lang, text],
+                             check=True, capture_output=True).stdout
+        return subprocess.run([ffmpeg_binary(), '-loglevel', 'error', '-f', 'wav', '-i', 'pipe:0', '-f', 'mp3', 'pipe:1'],
+                              input=wav, check=True, capture_output=True).stdout
+
+TTS_BACKENDS = {
+    GTTSBackend.name: GTTSBackend,
+    EspeakBackend.name: EspeakBackend,
+}
+
+def synthesize_to_file(backend:TTSBackend, text:str, file:str, cache = None):
+    """Synthesizes text into an MP3 file, reusing cached audio when available.
+
+    Args:
+        backend: text to speech engine
+        text: text to narrate
+        file: output MP3 file
+        cache: optional DiskCache keyed by backend, voice, language and text
+    """
+    with measure(f'tts.{backend.name}') as m:
+        key = cache_key('tts', backend.name, backend.voice, backend.lang, text)
+        audio = cache.get(key) if cache is not None else None
+        if audio is None:
+            audio = backend.synthesize(text)
+            if cache is not None:
+                cache.set(key, audio)
+        else:
+            m.add(cache_hits=1)
+        with open(file, 'wb') as f:
+            f.write(audio)
+        m.add(bytes_written=len(audio))
+
+def page_text(page_data):
+    """Returns narration text of a page."""
+    return page_data.content.replace("'","")
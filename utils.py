@@ -1,9 +1,32 @@
-from bs4 import BeautifulSoup
-import requests
+import asyncio
+import contextlib
 import os
+import re
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import islice
 from models import ChildrenStory
 from pydantic_core import from_json
-import pypdf
+
+from cache import cache_key
+from metrics import (measure, add)
+from singleflight import single_flight
+
+URL_TIMEOUT = 30
+URL_MAX_BYTES = 20 * 1024 * 1024
+URL_CHUNK_SIZE = 64 * 1024
+PDF_PARALLEL_PAGES = 64
+PDF_BATCH_PAGES = 16
+
+_flight = single_flight('url')
+
+@lru_cache(maxsize=None)
+def http_session():
+    """Returns the pooled HTTP session of the process, created on first use."""
+    import requests
+    return requests.Session()
 
 def write_file(content:str, file:str):
     """Writes a text file.
@@ -14,6 +37,7 @@ def write_file(content:str, file:str):
     """
     with open(file, "w", encoding="utf-8") as outfile:
         outfile.write(content)
+    add(bytes_written=len(content.encode("utf-8")))
 
 def read_file(file:str):
     """Reads a file.
@@ -26,6 +50,46 @@ def read_file(file:str):
     with open(file, 'r') as openfile:
         return openfile.read()
 
+def extract_pdf_pages(file_path:str, start:int, stop:int):
+    """Returns text of the pdf pages in the range [start, stop)."""
+    import pymupdf
+    with pymupdf.open(file_path) as doc:
+        return [doc.load_page(number).get_text() for number in range(start, stop)]
+
+def iter_pdf_pages(file_path:str, max_workers:int = None, batch_size:int = PDF_BATCH_PAGES, executor = None):
+    """Yields text of pdf pages lazily in page order.
+
+    Small documents are read page by page in the calling thread. Documents
+    with more than PDF_PARALLEL_PAGES pages are extracted in batches of pages
+    by a process pool with a bounded number of batches in flight, so only a
+    few batches are held in memory at a time. The pool of the caller is used
+    when given, otherwise a pool is started for the document.
+
+    Args:
+        file_path: full path and name of the pdf file
+        max_workers: size of the process pool, defaults to the number of cores
+        batch_size: number of pages extracted by one job
+        executor: optional process pool of the caller
+    Returns:
+        generator of page texts
+    """
+    import pymupdf
+    with pymupdf.open(file_path) as doc:
+        page_count = doc.page_count
+        if page_count <= PDF_PARALLEL_PAGES:
+            for number in range(page_count):
+                yield doc.load_page(number).get_text()
+            return
+    max_workers = max_workers or os.cpu_count() or 1
+    ranges = iter([(start, min(start + batch_size, page_count)) for start in range(0, page_count, batch_size)])
+    with contextlib.nullcontext(executor) if executor is not None else ProcessPoolExecutor(max_workers) as executor:
+        pending = deque(executor.submit(extract_pdf_pages, file_path, *r) for r in islice(ranges, 2 * max_workers))
+        while pending:
+            pages = pending.popleft().result()
+            for r in islice(ranges, 1):
+                pending.append(executor.submit(extract_pdf_pages, file_path, *r))
+            yield from pages
+
 def read_pdf(file_path):
     """Reads pdf file.
 
@@ -34,40 +98,163 @@ def read_pdf(file_path):
     Returns:
         text from the pdf file
     """
-    with open(file_path, "rb") as pdf_file:
-        pdf_reader = pypdf.PdfReader(pdf_file)
-        num_pages = len(pdf_reader.pages)
-
-        text = ""
-        for page_num in range(num_pages):
-            page = pdf_reader.pages[page_num]
-            text += page.extract_text()
-    return text
-    
-def save_url_data(url, file):
+    return "".join(iter_pdf_pages(file_path))
+
+def html_to_text(html_content:bytes):
+    """Extracts whitespace normalized text from the body of an html document.
+
+    Uses lxml when it is installed and falls back to BeautifulSoup with the
+    pure Python html.parser otherwise. Script and style elements are skipped.
+
+    Args:
+        html_content: html document
+    Returns:
+        body text
+    """
+    try:
+        from lxml import html as lxml_html
+    except ImportError:
+        lxml_html = None
+    if lxml_html is not None:
+        doc = lxml_html.document_fromstring(html_content)
+        body = doc.find('body')
+        body = doc if body is None else body
+        for element in list(body.iter('script', 'style')):
+            element.drop_tree()
+        body_text = body.text_content()
+    else:
+        from bs4 import BeautifulSoup
+        soup = BeautifulSoup(html_content, 'html.parser')
+        body = soup.body or soup
+        for element in body(['script', 'style']):
+            element.decompose()
+        body_text = body.get_text()
+    return " ".join(body_text.split())
+
+def max_age(response):
+    """Returns seconds a response may be reused without revalidation, 0 when it must be revalidated."""
+    cache_control = response.headers.get('Cache-Control', '').lower()
+    if 'no-cache' in cache_control or 'no-store' in cache_control:
+        return 0
+    match = re.search(r'max-age=(\d+)', cache_control)
+    return int(match.group(1)) if match else 0
+
+def read_limited(response, max_bytes:int):
+    """Streams a response body, failing once it grows over max_bytes."""
+    length = response.headers.get('Content-Length')
+    if length and length.isdigit() and int(length) > max_bytes:
+        raise ValueError(f'{response.url} is larger than {max_bytes} bytes')
+    chunks = []
+    size = 0
+    for chunk in response.iter_content(URL_CHUNK_SIZE):
+        size += len(chunk)
+        if size > max_bytes:
+            raise ValueError(f'{response.url} is larger than {max_bytes} bytes')
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+def fetch_url_text(url:str, cache = None, timeout:float = URL_TIMEOUT, max_bytes:int = URL_MAX_BYTES):
+    """Gets the body text of an html document, using an HTTP cache when available.
+
+    The cache keeps the extracted text with the ETag and Last-Modified
+    validators of the response. A cached entry is reused without a request
+    while its Cache-Control max-age lasts and is revalidated with a
+    conditional GET afterwards, so an unchanged page costs one 304 round trip.
+    Downloads are streamed and abort once they exceed max_bytes.
+
+    Args:
+        url: url
+        cache: optional DiskCache of url responses
+        timeout: connect and read timeout in seconds
+        max_bytes: maximum size of the downloaded document
+    Returns:
+        body text
+    """
+    with measure('url.fetch') as m:
+        key = cache_key('url', url)
+        entry = cache.get_json(key) if cache is not None else None
+        if entry is not None and entry.get('expires', 0) > time.time():
+            m.add(cache_hits=1)
+            return entry['text']
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        with http_session().get(url, headers=headers, timeout=timeout, stream=True) as response:
+            if response.status_code == 304 and entry is not None:
+                m.add(cache_hits=1)
+                text = entry['text']
+            else:
+                response.raise_for_status()
+                html_content = read_limited(response, max_bytes)
+                m.add(bytes_downloaded=len(html_content))
+                text = html_to_text(html_content)
+            if cache is not None:
+                cache.set_json(key, {
+                    'text': text,
+                    'etag': response.headers.get('ETag', entry and entry.get('etag')),
+                    'last_modified': response.headers.get('Last-Modified', entry and entry.get('last_modified')),
+                    'expires': time.time() + max_age(response),
+                })
+        return text
+
+def save_url_data(url, file, cache = None, timeout:float = URL_TIMEOUT, max_bytes:int = URL_MAX_BYTES):
     """Gets html document from a URL and saves content as a local file
 
     Args:
         url: url
         file: local file path and name
+        cache: optional DiskCache of url responses
+        timeout: connect and read timeout in seconds
+        max_bytes: maximum size of the downloaded document
+    """
+    #concurrent runs reading the same url share one download
+    write_file(_flight.do(url, fetch_url_text, url, cache, timeout, max_bytes), file)
+
+async def gather_with_concurrency(limit:int, *coros):
+    """Awaits coroutines concurrently with at most `limit` of them in flight.
+
+    Args:
+        limit: maximum number of coroutines running at the same time
+        coros: coroutines to await
     Returns:
-        Generated image in base64 format
+        results in the same order as the coroutines passed
     """
-    
-    # Fetch the HTML content
-    url = url
-    response = requests.get(url)
-    html_content = response.content
-    
-    # Parse the HTML
-    soup = BeautifulSoup(html_content, 'html.parser')
-    
-    # Extract the text from the body
-    body_text = soup.body.get_text()
-    
-    # Save the text
-    body_text = " ".join(body_text.split()) 
-    write_file(body_text, file)
+    semaphore = asyncio.Semaphore(max(1, limit))
+
+    async def run(coro):
+        async with semaphore:
+            return await coro
+    return await asyncio.gather(*(run(coro) for coro in coros))
+
+async def iterate_in_thread(iterable):
+    """Iterates a blocking iterable from async code, advancing it in a worker thread.
+
+    Args:
+        iterable: iterable whose items are slow to produce
+    Returns:
+        async generator of the items
+    """
+    iterator = iter(iterable)
+    done = object()
+    while (item := await asyncio.to_thread(next, iterator, done)) is not done:
+        yield item
+
+def init_workspace(path:str, *subdirs:str):
+    """Creates a run workspace directory and its sub directories.
+
+    Args:
+        path: workspace directory
+        subdirs: sub directories for generated artifacts
+    Returns:
+        workspace directory
+    """
+    os.makedirs(path, exist_ok=True)
+    for subdir in subdirs:
+        os.makedirs(os.path.join(path, subdir), exist_ok=True)
+    return path
 
 def has_file(dir_path, filename):
     """Checks if a file exists in the given directory."""
@@ -80,15 +267,6 @@ def parse_prompt(file_name):
     prompt = prompt[index+1:-1]
     return prompt
 
-def has_prompts(path, story):
-    """Checks if prompts were previously stored."""
-    if not has_file(path, 'title_prompt.txt'):
-        return False
-    for i, _ in enumerate(story.pages):
-        if not has_file(path, f'{str(i)}_prompt.txt'):
-            return False
-    return True
-    
 def get_full_story_with_title(story:ChildrenStory):
     """Returns full story to be passed in prompt to LLM.
 
@@ -1,11 +1,37 @@
-from moviepy.editor import *
-import moviepy.editor as mp
+import os
+import subprocess
+from functools import lru_cache
 from PIL import Image as pil
-from pkg_resources import parse_version
-from gtts import gTTS
 
-if parse_version(pil.__version__)>=parse_version('10.0.0'):
-    pil.ANTIALIAS=pil.LANCZOS
+#all page clips are encoded with identical parameters so they can be joined without re-encoding
+VIDEO_FPS = 24
+VIDEO_CODEC = "libx264"
+AUDIO_CODEC = "aac"
+AUDIO_FPS = 44100
+FFMPEG_PARAMS = ["-pix_fmt", "yuv420p"]
+
+#still image profile: low frame rate and long GOP since every page is a static picture
+STILL_FPS = 5
+STILL_GOP_SECONDS = 10
+
+@lru_cache(maxsize=None)
+def moviepy_editor():
+    """Returns the moviepy.editor module, imported on first use since it is slow to load."""
+    #moviepy resizes with the ANTIALIAS filter removed in Pillow 10
+    if not hasattr(pil, 'ANTIALIAS'):
+        pil.ANTIALIAS = pil.LANCZOS
+    import moviepy.editor
+    return moviepy.editor
+
+@lru_cache(maxsize=None)
+def ffmpeg_binary():
+    """Returns the ffmpeg executable configured for moviepy."""
+    from moviepy.config import get_setting
+    return get_setting("FFMPEG_BINARY")
+
+def temp_audio_file(video_path):
+    """Returns temporary audio file used while writing the given video, next to the video."""
+    return f"{os.path.splitext(video_path)[0]}-temp-audio.m4a"
 
 def merge_audio_video(image_path, audio_path, video_path):
     """Merges audio and video files and generates video clip
@@ -15,64 +41,98 @@ def merge_audio_video(image_path, audio_path, video_path):
         audio_path: path of audio file to be used for generating video
         video_path: output video path
     """
-    image = pil.open(image_path)
-    audio_clip = AudioFileClip(audio_path)
-    image_clip = ImageClip(image_path, duration=audio_clip.duration)
-    image_clip = image_clip.resize(image.size)
+    mp = moviepy_editor()
+    with pil.open(image_path) as image:
+        size = image.size
+    audio_clip = mp.AudioFileClip(audio_path)
+    image_clip = mp.ImageClip(image_path, duration=audio_clip.duration)
+    image_clip = image_clip.resize(size)
     # Combine the image and audio
     video_clip = image_clip.set_audio(audio_clip)
     # Write the video to a file
-    video_clip.write_videofile(video_path, fps=24, codec="libx264",temp_audiofile="temp-audio.m4a", remove_temp=True, audio_codec="aac")
+    video_clip.write_videofile(video_path, fps=VIDEO_FPS, codec=VIDEO_CODEC, temp_audiofile=temp_audio_file(video_path), remove_temp=True,
+                               audio_codec=AUDIO_CODEC, audio_fps=AUDIO_FPS, ffmpeg_params=FFMPEG_PARAMS)
+    video_clip.close()
+    audio_clip.close()
 
 def combine_videos(video_clips, output_file):
-    """Combines multiple video clips into a single movie file."""
+    """Combines multiple video clips into a single movie file.
 
-    clips = [mp.VideoFileClip(clip) for clip in video_clips]
-    final_clip = mp.concatenate_videoclips(clips)
-    final_clip.write_videofile(output_file, fps=24, codec="libx264",temp_audiofile="temp-audio.m4a", remove_temp=True, audio_codec="aac")
+    Clips are joined with the ffmpeg concat demuxer using stream copy, so no
+    frame is decoded or re-encoded. All clips must share codec parameters,
+    which holds for clips written by merge_audio_video.
+    """
+    list_file = f"{os.path.splitext(output_file)[0]}-concat.txt"
+    with open(list_file, "w", encoding="utf-8") as f:
+        for clip in video_clips:
+            f.write(f"file '{concat_list_path(clip)}'\n")
+    try:
+        subprocess.run([ffmpeg_binary(), "-y", "-loglevel", "error", "-f", "concat", "-safe", "0",
+                        "-i", list_file, "-c", "copy", "-movflags", "+faststart", output_file], check=True)
+    finally:
+        os.remove(list_file)
 
 
-def save_video(page_count, video_path, output_file):
-    """Aggregates multiple video clips and save as a single merged video"""
-    video_files = [f'{video_path}/{i}.mp4' for i in range(page_count)]
-    combine_videos(video_files, output_file)
+def concat_list_path(path):
+    """Returns a path quoted for an ffmpeg concat list file."""
+    return os.path.abspath(path).replace("'", "'\\''")
 
+def audio_duration(audio_path):
+    """Returns duration of an audio file in seconds."""
+    audio_clip = moviepy_editor().AudioFileClip(audio_path)
+    duration = audio_clip.duration
+    audio_clip.close()
+    return duration
 
-def save_audio(data, audio_path):
-    """Creates audio files
+def render_still_video(image_files, audio_files, output_file, fps=STILL_FPS):
+    """Renders still images with their narration into a video in a single encode.
+
+    Each image is shown for the duration of its audio file. The image and
+    audio timelines are built with the ffmpeg concat demuxer and encoded once
+    with a still image profile.
 
     Args:
-        data: data with multiple texts to convert audio
-        audio_path: path of audio file to be used for generating video
+        image_files: image file of every page
+        audio_files: audio file of every page
+        output_file: output video file
+        fps: output frame rate
     """
-    # Create title audio file
-    title = data.title
-    ff = f"{audio_path}/title.mp3"
-    tts = gTTS(title, lang='en')
-    tts.save(ff)
-    # Create page audio file
-    for page_data in data.pages:
-        ff = f"{audio_path}/{page_data.page_no}.mp3"
-        page_text = page_data.content.replace("'","")
-        tts = gTTS(page_text, lang='en')
-        tts.save(ff)
-
-def save_audio_video(data, image_path, audio_path, video_path):
-    """Merges image and audio to create video files
+    base = os.path.splitext(output_file)[0]
+    image_list = f"{base}-images.txt"
+    audio_list = f"{base}-audio.txt"
+    with open(image_list, "w", encoding="utf-8") as images, open(audio_list, "w", encoding="utf-8") as audios:
+        for image_file, audio_file in zip(image_files, audio_files):
+            images.write(f"file '{concat_list_path(image_file)}'\nduration {audio_duration(audio_file):.3f}\n")
+            audios.write(f"file '{concat_list_path(audio_file)}'\n")
+        #concat demuxer needs the last image repeated to apply its duration
+        images.write(f"file '{concat_list_path(image_files[-1])}'\n")
+    try:
+        subprocess.run([ffmpeg_binary(), "-y", "-loglevel", "error",
+                        "-f", "concat", "-safe", "0", "-i", image_list,
+                        "-f", "concat", "-safe", "0", "-i", audio_list,
+                        "-map", "0:v", "-map", "1:a",
+                        "-vf", "scale=trunc(iw/2)*2:trunc(ih/2)*2", "-r", str(fps),
+                        "-c:v", VIDEO_CODEC, "-tune", "stillimage", "-g", str(fps * STILL_GOP_SECONDS), *FFMPEG_PARAMS,
+                        "-c:a", AUDIO_CODEC, "-ar", str(AUDIO_FPS), "-shortest", "-movflags", "+faststart", output_file], check=True)
+    finally:
+        os.remove(image_list)
+        os.remove(audio_list)
+
+def save_still_video(data, image_path, audio_path, output_file, fps=STILL_FPS):
+    """Creates the story video in a single pass without per page clips
 
     Args:
         data: data with multiple page data
         image_path: image file directory
         audio_path: audio file directory
-        video_path: output video path
+        output_file: output video file
+        fps: output frame rate
     """
-    title = data.title
-    a_p = f"{audio_path}/title.mp3"
-    i_p = f"{image_path}/0.png"
-    v_p = f"{video_path}/0.mp4"
-    merge_audio_video(i_p, a_p, v_p)
-    for page_data in data.pages:
-        a_p = f"{audio_path}/{page_data.page_no}.mp3"
-        i_p = f"{image_path}/{page_data.page_no}.png"
-        v_p = f"{video_path}/{page_data.page_no}.mp4"
-        merge_audio_video(i_p, a_p, v_p)
\ No newline at end of file
+    image_files = [f"{image_path}/0.png"] + [f"{image_path}/{page_data.page_no}.png" for page_data in data.pages]
+    audio_files = [f"{audio_path}/title.mp3"] + [f"{audio_path}/{page_data.page_no}.mp3" for page_data in data.pages]
+    render_still_video(image_files, audio_files, output_file, fps)
+
+def save_video(page_count, video_path, output_file):
+    """Aggregates multiple video clips and save as a single merged video"""
+    video_files = [f'{video_path}/{i}.mp4' for i in range(page_count)]
+    combine_videos(video_files, output_file)